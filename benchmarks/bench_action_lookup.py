@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark comparing the per-click cost of resolving a button action by
+parsing the XML on every click (the old behaviour) against the in-memory index
+built at startup.
+
+Run from the repository root:
+    poetry run python benchmarks/bench_action_lookup.py
+"""
+import os
+import sys
+import timeit
+from typing import List, Optional
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+ITERATIONS = 2000
+
+
+def xml_get_action_for_id(filename: str, custom_id: str) -> Optional[str]:
+    tree = ElementTree.parse(filename)
+    for button_tag in tree.getroot().findall("./button"):
+        if button_tag.attrib.get("id", None) == custom_id:
+            return button_tag.attrib.get("action", None)
+    return None
+
+
+def xml_get_unique_group_roles(filename: str, unique_group_name: str) -> List[int]:
+    result: List[int] = []
+    tree = ElementTree.parse(filename)
+    for button_tag in tree.getroot().findall("./button"):
+        action_str = button_tag.attrib.get("action", "")
+        if action_str.startswith(f"toggle-role:{unique_group_name}:"):
+            result.append(int(action_str.split(":")[2]))
+    return result
+
+
+def xml_click(custom_id: str):
+    filename = f"{bot.MESSAGES_DIR}/{custom_id.split('_')[0]}.xml"
+    action_str = xml_get_action_for_id(filename, custom_id) or ""
+    if action_str.count(":") == 2:
+        xml_get_unique_group_roles(filename, action_str.split(":")[1])
+
+
+def index_click(custom_id: str):
+    action = bot.action_index.actions.get(custom_id, None)
+    if action is not None and action.unique_group is not None:
+        bot.action_index.unique_groups.get((action.source, action.unique_group), [])
+
+
+def main():
+    for custom_id in ["year_4", "pronouns_theythem", "protectedgroups_trans"]:
+        xml_time = timeit.timeit(lambda: xml_click(custom_id), number=ITERATIONS)
+        index_time = timeit.timeit(lambda: index_click(custom_id), number=ITERATIONS)
+        print(
+            f"{custom_id:<24} xml: {xml_time / ITERATIONS * 1e6:9.2f} us/click"
+            f"  index: {index_time / ITERATIONS * 1e6:7.3f} us/click"
+            f"  ({xml_time / index_time:,.0f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
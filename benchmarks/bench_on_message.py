@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-message overhead of on_message for ordinary chat
+messages (i.e. ones that no handler acts upon), comparing the old handler
+chain against the channel-routed dispatch.
+
+Run from the repository root:
+    poetry run python benchmarks/bench_on_message.py
+"""
+import asyncio
+import os
+import re
+import sys
+import time
+import types
+from datetime import datetime, timezone
+
+os.environ.setdefault("SERVER_SUGGESTIONS_CHANNEL_ID", "1")
+os.environ.setdefault("SERVER_SUGGESTIONS_GUILD_ID", "2")
+os.environ.setdefault("SERVER_SUGGESTIONS_UP_EMOJI_ID", "3")
+os.environ.setdefault("SERVER_SUGGESTIONS_DOWN_EMOJI_ID", "4")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+MESSAGES = 20000
+RATE = 1000
+
+HONEYPOT_CHANNEL_ID = str(bot.settings.honeypot_channel_id)
+
+
+async def legacy_handle_suggestion_react(message):
+    if message.author == bot.bot.user:
+        return
+    if message.guild is None:
+        return
+    if message.is_system():
+        return
+    if (
+        "SERVER_SUGGESTIONS_DISABLE" in os.environ
+        and os.environ["SERVER_SUGGESTIONS_DISABLE"] == "1"
+    ):
+        return
+    if (
+        "SERVER_SUGGESTIONS_CHANNEL_ID" not in os.environ
+        or "SERVER_SUGGESTIONS_GUILD_ID" not in os.environ
+        or "SERVER_SUGGESTIONS_UP_EMOJI_ID" not in os.environ
+        or "SERVER_SUGGESTIONS_DOWN_EMOJI_ID" not in os.environ
+    ):
+        return
+    if (
+        str(message.channel.id) != os.environ["SERVER_SUGGESTIONS_CHANNEL_ID"]
+        or str(message.guild.id) != os.environ["SERVER_SUGGESTIONS_GUILD_ID"]
+    ):
+        return
+
+
+async def legacy_handle_is_myed_down(message):
+    if message.author == bot.bot.user:
+        return
+    if re.match(r"^(is +)?(my *ed|learn|[\/&\+])* +down( |\?|$)", message.content, re.IGNORECASE | re.MULTILINE):
+        raise AssertionError("benchmark messages should not match")
+
+
+async def legacy_on_message(message):
+    await legacy_handle_suggestion_react(message)
+    if str(message.channel.id) == HONEYPOT_CHANNEL_ID:
+        raise AssertionError("benchmark messages should not be in the honeypot")
+    else:
+        await legacy_handle_is_myed_down(message)
+
+
+def make_messages():
+    guild = types.SimpleNamespace(id=2)
+    created_at = datetime.now(timezone.utc)
+    messages = []
+    for i in range(MESSAGES):
+        messages.append(types.SimpleNamespace(
+            id=i,
+            author=types.SimpleNamespace(id=i % 500, bot=False),
+            guild=guild,
+            channel=types.SimpleNamespace(id=100 + i % 50),
+            content=f"has anyone started the coursework for week {i % 11} yet",
+            created_at=created_at,
+            is_system=lambda: False,
+            # on_message also runs the message through the command parser
+            _state=bot.bot._connection,
+        ))
+    return messages
+
+
+async def run(handler, messages) -> float:
+    started = time.perf_counter()
+    for message in messages:
+        await handler(message)
+    return time.perf_counter() - started
+
+
+def main():
+    # Stand-in for the logged-in user, which on_message and the command
+    # parser compare message authors against
+    bot.bot._connection.user = types.SimpleNamespace(id=999_999_999, name="channelbot")
+    messages = make_messages()
+    for name, handler in [("legacy", legacy_on_message), ("routed", bot.on_message)]:
+        elapsed = asyncio.run(run(handler, messages))
+        per_message = elapsed / MESSAGES
+        print(
+            f"{name:<8} {per_message * 1e6:7.2f} us/message"
+            f"  ({per_message * RATE * 100:.2f}% of the event loop at {RATE} msgs/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
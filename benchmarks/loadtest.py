@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the bot's hot paths. Drives on_interaction, on_message
+and handle_spam_pings with synthetic traffic against an in-process stand-in
+for the Discord REST API (with simulated latency and per-bucket 429s) and a
+local HTTP server standing in for MyEd/Learn. Nothing talks to Discord.
+
+Scenarios:
+    clicks    freshers' week click storm on the year/pronoun buttons
+    raid      many accounts posting in the honeypot channel at once
+    status    a flood of "is learn down" messages during an outage
+
+Run from the repository root:
+    poetry run python benchmarks/loadtest.py [clicks] [raid] [status]
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import time
+import types
+from collections import Counter, deque
+from datetime import timedelta
+from typing import Deque, Dict, List, Optional, Tuple
+
+os.environ.setdefault("SERVER_SUGGESTIONS_DISABLE", "1")
+os.environ.setdefault("HONEYPOT_CHANNEL_ID", "1000")
+os.environ.setdefault("MODERATION_CHANNEL_ID", "1001")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("AUDIT_LOG", ":memory:")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp.web
+import discord
+
+import bot
+
+GUILD_ID = 315277951597936640
+
+
+class FakeREST:
+    """
+    Stand-in for the Discord REST API. Every call sleeps for a simulated
+    network latency, and each rate-limit bucket allows `limit` calls per
+    `per` seconds. Calls over the limit are counted as 429s and retried after
+    the bucket resets, like py-cord does.
+    """
+
+    def __init__(self, latency: float, limit: int, per: float):
+        self.latency = latency
+        self.limit = limit
+        self.per = per
+        self.calls: Counter = Counter()
+        self.rate_limited = 0
+        # bucket -> monotonic times of the calls in the current window
+        self.windows: Dict[str, Deque[float]] = {}
+
+    async def request(self, route: str, bucket: Optional[str]):
+        self.calls[route] += 1
+        while bucket is not None:
+            window = self.windows.setdefault(bucket, deque())
+            now = time.monotonic()
+            while window and now - window[0] >= self.per:
+                window.popleft()
+            if len(window) < self.limit:
+                window.append(now)
+                break
+            self.rate_limited += 1
+            await asyncio.sleep(self.per - (now - window[0]))
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id = role_id
+        self.name = f"role-{role_id}"
+        self.mention = f"<@&{role_id}>"
+
+    def is_default(self) -> bool:
+        return self.id == GUILD_ID
+
+
+class FakeMember(discord.Member):
+    id = property(lambda self: self._id)
+    name = property(lambda self: f"user{self._id}")
+    mention = property(lambda self: f"<@{self._id}>")
+    roles = property(lambda self: self._fake_roles)
+    bot = property(lambda self: False)
+
+    def __init__(self, member_id: int, guild: "FakeGuild", rest: FakeREST):
+        self._id = member_id
+        self.guild = guild
+        self._rest = rest
+        self._fake_roles: List[FakeRole] = [guild.default_role]
+
+    async def add_roles(self, *roles, reason=None, atomic=True):
+        for role in roles:
+            await self._rest.request("PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}", f"guild:{self.guild.id}")
+            self._fake_roles.append(role)
+
+    async def remove_roles(self, *roles, reason=None, atomic=True):
+        for role in roles:
+            await self._rest.request("DELETE /guilds/{guild_id}/members/{user_id}/roles/{role_id}", f"guild:{self.guild.id}")
+            self._fake_roles.remove(role)
+
+    async def edit(self, *, roles=None, reason=None, **kwargs):
+        await self._rest.request("PATCH /guilds/{guild_id}/members/{user_id}", f"guild:{self.guild.id}")
+        if roles is not None:
+            self._fake_roles = [self.guild.default_role] + list(roles)
+
+    async def timeout(self, until, *, reason=None):
+        await self._rest.request("PATCH /guilds/{guild_id}/members/{user_id}", f"guild:{self.guild.id}")
+
+
+class FakeTextChannel(discord.TextChannel):
+    def __init__(self, channel_id: int, guild: "FakeGuild", rest: FakeREST):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.guild = guild
+        self._rest = rest
+        self._overwrites: Dict[int, bool] = {}
+        self._fake_history: List[types.SimpleNamespace] = []
+        self.sent: List[float] = []
+
+    def permissions_for(self, obj):
+        return discord.Permissions.all()
+
+    def overwrites_for(self, obj):
+        return discord.PermissionOverwrite(read_messages=self._overwrites.get(obj.id, None))
+
+    async def set_permissions(self, target, *, reason=None, **permissions):
+        await self._rest.request("PUT /channels/{channel_id}/permissions/{overwrite_id}", f"channel:{self.id}")
+        self._overwrites[target.id] = permissions["read_messages"]
+
+    async def send(self, content=None, **kwargs):
+        await self._rest.request("POST /channels/{channel_id}/messages", f"channel:{self.id}")
+        self.sent.append(time.perf_counter())
+
+    async def trigger_typing(self):
+        await self._rest.request("POST /channels/{channel_id}/typing", f"channel:{self.id}")
+
+    async def purge(self, *, limit=None, after=None, check=None, **kwargs):
+        # One history page per 100 messages, then one bulk delete per 100 matches
+        for _ in range(0, max(len(self._fake_history), 1), 100):
+            await self._rest.request("GET /channels/{channel_id}/messages", f"channel:{self.id}")
+        deleted = [message for message in self._fake_history if check(message)]
+        for _ in range(0, len(deleted), 100):
+            await self._rest.request("POST /channels/{channel_id}/messages/bulk-delete", f"channel:{self.id}")
+        self._fake_history = [message for message in self._fake_history if not check(message)]
+        return deleted
+
+    async def delete_messages(self, messages):
+        await self._rest.request("POST /channels/{channel_id}/messages/bulk-delete", f"channel:{self.id}")
+        message_ids = {message.id for message in messages}
+        self._fake_history = [message for message in self._fake_history if message.id not in message_ids]
+
+
+class FakeGuild:
+    def __init__(self, rest: FakeREST, channels: int, members: int):
+        self.id = GUILD_ID
+        self.default_role = FakeRole(GUILD_ID)
+        self.me = None
+        self.roles: Dict[int, FakeRole] = {}
+        for action in bot.action_index.actions.values():
+            if action.kind == "toggle-role":
+                self.roles[action.target_id] = FakeRole(action.target_id)
+
+        channel_ids = [bot.settings.honeypot_channel_id, bot.settings.moderation_channel_id]
+        channel_ids += [action.target_id for action in bot.action_index.actions.values() if action.kind == "toggle-channel"]
+        channel_ids += range(2000, 2000 + channels)
+        self.channels = {channel_id: FakeTextChannel(channel_id, self, rest) for channel_id in channel_ids}
+        self.text_channels = list(self.channels.values())
+        self.members = {member_id: FakeMember(member_id, self, rest) for member_id in range(1, members + 1)}
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return self.roles.get(role_id, None)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeTextChannel]:
+        return self.channels.get(channel_id, None)
+
+    def get_channel_or_thread(self, channel_id: int) -> Optional[FakeTextChannel]:
+        return self.channels.get(channel_id, None)
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        return self.members.get(member_id, None)
+
+
+class FakeInteractionResponse:
+    def __init__(self, rest: FakeREST):
+        self.rest = rest
+
+    async def defer(self, **kwargs):
+        await self.rest.request("POST /interactions/{interaction_id}/{token}/callback", None)
+
+
+class FakeFollowup:
+    def __init__(self, rest: FakeREST, done: "asyncio.Future[float]"):
+        self.rest = rest
+        self.done = done
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.request("POST /webhooks/{application_id}/{token}", None)
+        if not self.done.done():
+            self.done.set_result((time.perf_counter(), content))
+
+
+def click_outcome(notice: str) -> str:
+    if notice == bot.BUSY_NOTICE:
+        return "rejected"
+    if notice == bot.FAILED_NOTICE:
+        return "failed"
+    return "completed"
+
+
+def make_interaction(interaction_id: int, guild: FakeGuild, member: FakeMember, custom_id: str, rest: FakeREST):
+    done = asyncio.get_running_loop().create_future()
+    interaction = types.SimpleNamespace(
+        id=interaction_id,
+        is_component=lambda: True,
+        application_id=bot.bot.application_id,
+        custom_id=custom_id,
+        guild=guild,
+        guild_id=guild.id,
+        user=member,
+        response=FakeInteractionResponse(rest),
+        followup=FakeFollowup(rest, done),
+    )
+    return interaction, done
+
+
+message_ids = iter(range(10**12, 10**13))
+
+
+def make_message(guild: FakeGuild, channel: FakeTextChannel, author: FakeMember, content: str):
+    message = types.SimpleNamespace(
+        id=next(message_ids),
+        author=author,
+        guild=guild,
+        channel=channel,
+        content=content,
+        created_at=discord.utils.utcnow(),
+        is_system=lambda: False,
+        # on_message also runs the message through the command parser
+        _state=bot.bot._connection,
+    )
+    channel._fake_history.append(message)
+    return message
+
+
+class Result:
+    """
+    `outcomes` counts every operation by how it ended; `latencies` only holds
+    the ones that completed, so shed or failed operations (which are answered
+    quickly) don't flatter the percentiles or throughput.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        latencies: List[float],
+        elapsed: float,
+        rest: FakeREST,
+        outcomes: Counter,
+        extra: str = "",
+    ):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.rest = rest
+        self.outcomes = outcomes
+        self.extra = extra
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return float("nan")
+        return self.latencies[min(len(self.latencies) - 1, int(p * len(self.latencies)))]
+
+    def report(self) -> str:
+        lines = [
+            f"== {self.name}",
+            f"  operations:  {sum(self.outcomes.values())} in {self.elapsed:.2f}s"
+            f" ({len(self.latencies) / self.elapsed:.1f}/s completed)",
+            f"  outcomes:    {', '.join(f'{outcome} {count}' for outcome, count in self.outcomes.most_common())}",
+            f"  latency:     p50 {self.percentile(0.5) * 1000:.1f}ms"
+            f"  p99 {self.percentile(0.99) * 1000:.1f}ms"
+            f"  max {self.latencies[-1] * 1000 if self.latencies else float('nan'):.1f}ms",
+            f"  REST calls:  {sum(self.rest.calls.values())} ({self.rest.rate_limited} rate limited)",
+        ]
+        for route, count in self.rest.calls.most_common():
+            lines.append(f"    {count:6}  {route}")
+        if self.extra:
+            lines.append(f"  {self.extra}")
+        return "\n".join(lines)
+
+
+async def scenario_clicks(args) -> Result:
+    rest = FakeREST(args.latency, args.bucket_limit, args.bucket_period)
+    guild = FakeGuild(rest, channels=10, members=args.users)
+    custom_ids = [custom_id for custom_id in bot.action_index.actions]
+
+    async def click(i: int) -> Tuple[str, float]:
+        member = guild.get_member(random.randint(1, args.users))
+        interaction, done = make_interaction(i, guild, member, random.choice(custom_ids), rest)
+        started = time.perf_counter()
+        await bot.on_interaction(interaction)
+        answered, notice = await done
+        return click_outcome(notice), answered - started
+
+    writes_before = dict(bot.WRITES.values)
+    started = time.perf_counter()
+    tasks = []
+    for i in range(args.clicks):
+        tasks.append(asyncio.create_task(click(i)))
+        await asyncio.sleep(random.expovariate(args.click_rate))
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    writes = {
+        key[0]: count - writes_before.get(key, 0)
+        for key, count in bot.WRITES.values.items()
+        if count != writes_before.get(key, 0)
+    }
+    return Result(
+        "click storm",
+        [latency for outcome, latency in results if outcome == "completed"],
+        elapsed,
+        rest,
+        Counter(outcome for outcome, _ in results),
+        f"scheduler writes: {writes}",
+    )
+
+
+async def scenario_raid(args) -> Result:
+    rest = FakeREST(args.latency, args.bucket_limit, args.bucket_period)
+    guild = FakeGuild(rest, channels=args.channels, members=args.raiders + 100)
+    bot.bot.get_guild = lambda guild_id: guild if guild_id == guild.id else None
+    # Pretend the bot has been up for a while, so the recent message index is used
+    bot.recent_messages.started_at = discord.utils.utcnow() - timedelta(hours=1)
+
+    channels = [channel for channel in guild.text_channels if channel.id >= 2000]
+    honeypot = guild.get_channel(bot.settings.honeypot_channel_id)
+    mod_channel = guild.get_channel(bot.settings.moderation_channel_id)
+
+    # Background chatter from ordinary members, then the raiders spam a few
+    # channels each before hitting the honeypot
+    for _ in range(args.channels * 20):
+        await bot.on_message(make_message(guild, random.choice(channels), guild.get_member(random.randint(args.raiders + 1, args.raiders + 100)), "hello"))
+    for raider in range(1, args.raiders + 1):
+        for channel in random.sample(channels, 3):
+            await bot.on_message(make_message(guild, channel, guild.get_member(raider), "@everyone free nitro"))
+
+    started = time.perf_counter()
+    for raider in range(1, args.raiders + 1):
+        await bot.on_message(make_message(guild, honeypot, guild.get_member(raider), "@everyone free nitro"))
+    while not mod_channel.sent:
+        await asyncio.sleep(0.01)
+    # Give any further batches a chance to finish
+    await asyncio.sleep(bot.moderation_queue.window + 0.5)
+    elapsed = time.perf_counter() - started
+
+    leftover = sum(
+        1 for channel in channels for message in channel._fake_history
+        if message.author.id <= args.raiders
+    )
+    return Result(
+        "honeypot raid",
+        [sent - started for sent in mod_channel.sent],
+        elapsed,
+        rest,
+        Counter(reported=len(mod_channel.sent)),
+        f"{args.raiders} raiders, {len(mod_channel.sent)} report(s), {leftover} spam message(s) left behind",
+    )
+
+
+async def scenario_status(args) -> Result:
+    probes = Counter()
+
+    async def handle_probe(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        probes[request.path] += 1
+        await asyncio.sleep(args.probe_latency)
+        return aiohttp.web.Response(status=503 if request.path == "/learn" else 200)
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/myed", handle_probe)
+    app.router.add_get("/learn", handle_probe)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    bot.STATUS_SERVICES[:] = [
+        ("MyEd", f"http://127.0.0.1:{port}/myed"),
+        ("Learn", f"http://127.0.0.1:{port}/learn"),
+    ]
+    bot.status_cache.clear()
+
+    rest = FakeREST(args.latency, args.bucket_limit, args.bucket_period)
+    guild = FakeGuild(rest, channels=args.channels, members=args.questions)
+    channels = [channel for channel in guild.text_channels if channel.id >= 2000]
+
+    async def ask(i: int) -> float:
+        channel = random.choice(channels)
+        sent_before = len(channel.sent)
+        started = time.perf_counter()
+        await bot.on_message(make_message(guild, channel, guild.get_member(i + 1), "is learn down?"))
+        return channel.sent[sent_before] - started if len(channel.sent) > sent_before else float("nan")
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(args.questions):
+        tasks.append(asyncio.create_task(ask(i)))
+        await asyncio.sleep(random.expovariate(args.question_rate))
+    latencies = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    answered = [latency for latency in latencies if not math.isnan(latency)]
+
+    await runner.cleanup()
+    if bot.http_session is not None:
+        await bot.http_session.close()
+    return Result(
+        "status question flood",
+        answered,
+        elapsed,
+        rest,
+        Counter(answered=len(answered), unanswered=len(latencies) - len(answered)),
+        f"probe requests served: {sum(probes.values())} ({dict(probes)})",
+    )
+
+
+SCENARIOS = {
+    "clicks": scenario_clicks,
+    "raid": scenario_raid,
+    "status": scenario_status,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.08, help="mean simulated REST latency in seconds")
+    parser.add_argument("--bucket-limit", type=int, default=10, help="requests allowed per bucket per period")
+    parser.add_argument("--bucket-period", type=float, default=1.0, help="rate limit period in seconds")
+    parser.add_argument("--clicks", type=int, default=500)
+    parser.add_argument("--click-rate", type=float, default=100, help="clicks per second")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--raiders", type=int, default=40)
+    parser.add_argument("--channels", type=int, default=150)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--question-rate", type=float, default=50, help="questions per second")
+    parser.add_argument("--probe-latency", type=float, default=1.0, help="MyEd/Learn response time in seconds")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    random.seed(args.seed)
+    # Stand-in for the logged-in user, which on_message and the command
+    # parser compare message authors against
+    bot.bot._connection.user = types.SimpleNamespace(id=999_999_999, name="channelbot")
+    for name in args.scenarios or SCENARIOS:
+        result = asyncio.run(SCENARIOS[name](args))
+        print(result.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,28 @@ import sys
 import traceback
 import random
 import re
-import requests
 import time
-import whois
+# Start of the startup clock; see mark_startup()
+PROCESS_STARTED = time.perf_counter()
 import os
-from datetime import timedelta
-from typing import List, Optional
-import xml.etree.ElementTree as ElementTree
+import glob
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
 import asyncio
+import concurrent.futures
+import weakref
+from collections import deque
+import aiohttp
+import logging
+import logging.handlers
+import atexit
+import json
+import queue
+import marshal
+import hashlib
+import math
+import socket
+import sqlite3
 
 sys.stdout = sys.stderr
 
@@ -19,295 +33,2066 @@ from discord.ext import commands, tasks
 
 import secrets as config
 
-HONEYPOT_CHANNEL_ID = os.environ.get("HONEYPOT_CHANNEL_ID") if "HONEYPOT_CHANNEL_ID" in os.environ else "1519984051795136512"
+"""
+Logging goes through a queue to a background thread that does the actual
+writing, so the event loop never blocks on stderr. Records are written as one
+JSON object per line, including any correlation fields passed via `extra`
+(e.g. interaction_id, guild_id, user_id).
+
+Levels default to LOG_LEVEL (INFO), and can be set per subsystem with
+LOG_LEVELS, e.g. LOG_LEVELS="honeypot=DEBUG,discord=WARNING". Names without
+a dot other than "discord" refer to loggers under "channelbot.".
+"""
+# Attributes every LogRecord has; anything else was passed via `extra`
+STANDARD_LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class RepeatedWarningFilter(logging.Filter):
+    """
+    Drop warnings identical to one logged less than `interval` seconds ago.
+    The next one let through carries a `suppressed` count. Errors are always
+    let through, since two tracebacks with the same message can still have
+    different causes.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        # (logger, level, message) -> (time.monotonic() last let through, suppressed since)
+        self.seen: Dict[Tuple[str, int, str], Tuple[float, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        key = (record.name, record.levelno, record.getMessage())
+        last_emitted, suppressed = self.seen.get(key, (0.0, 0))
+        if now - last_emitted < self.interval:
+            self.seen[key] = (last_emitted, suppressed + 1)
+            return False
+
+        if len(self.seen) > 1000:
+            # Don't grow forever if messages contain IDs
+            self.seen.clear()
+        self.seen[key] = (now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Route all logging through a queue to a stderr writer thread, and apply
+    LOG_LEVEL and LOG_LEVELS. Returns the started listener.
+    """
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(JSONFormatter())
+    queue_handler.addFilter(RepeatedWarningFilter(float(os.environ.get("LOG_DEDUPE_SECONDS", "60"))))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    for entry in os.environ.get("LOG_LEVELS", "").split(","):
+        if "=" not in entry:
+            continue
+        name, level = (part.strip() for part in entry.split("=", 1))
+        if "." not in name and name != "discord":
+            name = f"channelbot.{name}"
+        logging.getLogger(name).setLevel(level.upper())
+
+    # The handler only writes the already-formatted JSON line
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+setup_logging()
+config_log = logging.getLogger("channelbot.config")
+interactions_log = logging.getLogger("channelbot.interactions")
+messages_log = logging.getLogger("channelbot.messages")
+commands_log = logging.getLogger("channelbot.commands")
+domains_log = logging.getLogger("channelbot.domains")
+status_log = logging.getLogger("channelbot.status")
+suggestions_log = logging.getLogger("channelbot.suggestions")
+honeypot_log = logging.getLogger("channelbot.honeypot")
+metrics_log = logging.getLogger("channelbot.metrics")
+audit_log = logging.getLogger("channelbot.audit")
+
+class SuggestionsSettings(NamedTuple):
+    channel_id: int
+    guild_id: int
+    up_emoji_id: int
+    down_emoji_id: int
+
+class Settings(NamedTuple):
+    """
+    Configuration read from environment variables, parsed once at startup so
+    the per-message handlers don't have to touch os.environ.
+    """
+    honeypot_channel_id: int
+    moderation_channel_id: int
+    # None if auto-reactions in the server suggestions channel are disabled
+    suggestions: Optional[SuggestionsSettings]
+
+def load_settings() -> Settings:
+    """
+    Build the Settings from environment variables, warning once about any that
+    are missing.
+    """
+    if "HONEYPOT_CHANNEL_ID" not in os.environ:
+        config_log.warning("Channel ID for Honeypot is not in environment variables. You must "
+                           "create a key called HONEYPOT_CHANNEL_ID with the channel id value.")
+
+    if "MODERATION_CHANNEL_ID" not in os.environ:
+        config_log.warning("Channel ID for Moderation is not in environment variables. You must "
+                           "create a key called MODERATION_CHANNEL_ID with the channel id "
+                           "value.")
+
+    suggestions = None
+    suggestions_keys = [
+        "SERVER_SUGGESTIONS_CHANNEL_ID",
+        "SERVER_SUGGESTIONS_GUILD_ID",
+        "SERVER_SUGGESTIONS_UP_EMOJI_ID",
+        "SERVER_SUGGESTIONS_DOWN_EMOJI_ID",
+    ]
+    if os.environ.get("SERVER_SUGGESTIONS_DISABLE", None) == "1":
+        # Allow disabling via environment variable
+        pass
+    elif any(key not in os.environ for key in suggestions_keys):
+        # None of channel, guild, emoji ID were provided
+        config_log.warning(
+            "One or more of the following environment variables not provided: %s. "
+            "To disable auto-reactions for server suggestions, set SERVER_SUGGESTIONS_DISABLE=1",
+            ", ".join(suggestions_keys),
+        )
+    else:
+        suggestions = SuggestionsSettings(*[int(os.environ[key]) for key in suggestions_keys])
+
+    return Settings(
+        honeypot_channel_id=int(os.environ.get("HONEYPOT_CHANNEL_ID", "1519984051795136512")),
+        moderation_channel_id=int(os.environ.get("MODERATION_CHANNEL_ID", "771063963605663835")),
+        suggestions=suggestions,
+    )
+
+settings = load_settings()
+
+"""
+Metrics are kept in-process and served in the Prometheus text format on
+http://0.0.0.0:$PORT/metrics, so we can see where time goes under load.
+"""
+METRICS: List["Metric"] = []
+
+def format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """
+    Base class for metrics. Label values are passed as keyword arguments,
+    and must match the label names given at construction.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        METRICS.append(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ])
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, description, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+class Gauge(Metric):
+    """
+    A gauge whose value is read from a callback at scrape time.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, read: Callable[[], float]):
+        super().__init__(name, description)
+        self.read = read
 
-MODERATION_CHANNEL_ID = os.environ.get("MODERATION_CHANNEL_ID") if "MODERATION_CHANNEL_ID" in os.environ else "771063963605663835"
+    def samples(self) -> List[str]:
+        value = self.read()
+        # Prometheus spells it NaN, Python spells it nan
+        return [f"{self.name} {'NaN' if math.isnan(value) else value}"]
 
+# Seconds; covers everything from a dict lookup to a slow multi-page purge
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-if "HONEYPOT_CHANNEL_ID" not in os.environ:
-    print("Channel ID for Honeypot is not in environment variables. You must "
-          "create a key called HONEYPOT_CHANNEL_ID with the channel id value.")
+class Histogram(Metric):
+    kind = "histogram"
 
-if "MODERATION_CHANNEL_ID" not in os.environ:
-    print("Channel ID for Honeypot is not in environment variables. You must "
-          "create a key called MODERATION_CHANNEL_ID with the channel id "
-          "value.")
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        # label values -> (per-bucket counts, sum, count)
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.key(labels)
+        counts, total, count = self.values.get(key, None) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {bucket_count}")
+            le = format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+INTERACTION_SECONDS = Histogram(
+    "channelbot_interaction_seconds",
+    "Time from receiving a button click to sending the followup.",
+    ("action",),
+)
+ACTION_SECONDS = Histogram(
+    "channelbot_action_seconds",
+    "Time spent in perform_action, including time queued for the write scheduler.",
+    ("action",),
+)
+ACTION_LOOKUPS = Counter(
+    "channelbot_action_lookups_total",
+    "Button custom_id lookups in the action index.",
+    ("result",),
+)
+XML_PARSES = Counter(
+    "channelbot_xml_parses_total",
+    "Times a messages/*.xml file was parsed.",
+)
+ACTION_INDEX_RELOADS = Counter(
+    "channelbot_action_index_reloads_total",
+    "Times the action index was rebuilt and swapped in.",
+)
+ACTION_INDEX_RELOAD_SECONDS = Histogram(
+    "channelbot_action_index_reload_seconds",
+    "Time taken to re-parse changed XML files and rebuild the action index.",
+)
+REST_REQUESTS = Counter(
+    "channelbot_rest_requests_total",
+    "Discord REST API requests, by method and route.",
+    ("method", "route"),
+)
+REST_RATE_LIMITED = Counter(
+    "channelbot_rest_rate_limited_total",
+    "Discord REST API responses with status 429.",
+)
+WRITE_QUEUE_WAIT_SECONDS = Histogram(
+    "channelbot_write_queue_wait_seconds",
+    "Time a role or channel write spent queued before being sent.",
+)
+WRITES = Counter(
+    "channelbot_writes_total",
+    "Role and channel writes submitted to the scheduler, by outcome.",
+    ("result",),
+)
+HONEYPOT_PURGE_SECONDS = Histogram(
+    "channelbot_honeypot_purge_seconds",
+    "Time taken to time out and purge a batch of honeypot users.",
+    ("mode",),
+)
+HONEYPOT_DELETED_MESSAGES = Counter(
+    "channelbot_honeypot_deleted_messages_total",
+    "Messages deleted by honeypot purges.",
+)
+HONEYPOT_USERS = Counter(
+    "channelbot_honeypot_users_total",
+    "Users timed out for posting in the honeypot channel.",
+)
+AUDIT_EVENTS = Counter(
+    "channelbot_audit_events_total",
+    "Audit log events, by whether they were written or dropped.",
+    ("result",),
+)
+STATUS_PROBE_SECONDS = Histogram(
+    "channelbot_status_probe_seconds",
+    "Latency of service status probes.",
+    ("service",),
+)
+STATUS_LOOKUPS = Counter(
+    "channelbot_status_lookups_total",
+    "Service status lookups, by whether they were served from the cache, "
+    "from another instance's probe, joined a running probe or started a new one.",
+    ("result",),
+)
+Gauge(
+    "channelbot_gateway_latency_seconds",
+    "Latency between a gateway HEARTBEAT and its ACK.",
+    lambda: bot.latency,
+)
+Gauge(
+    "channelbot_write_queue_depth",
+    "Role and channel writes currently queued.",
+    lambda: write_scheduler.depth(),
+)
+Gauge(
+    "channelbot_audit_buffer_depth",
+    "Audit log events waiting to be written.",
+    lambda: len(audit_store.buffer),
+)
+Gauge(
+    "channelbot_suggestion_queue_depth",
+    "Suggestions waiting for their reactions.",
+    lambda: suggestion_reactor.queue.qsize(),
+)
+
+"""
+Seconds from the start of bot.py to each step of startup, so we can see where
+a slow pod restart spends its time: finishing imports and loading the buttons,
+the first gateway READY, and the first button click handled after that.
+"""
+startup_times: Dict[str, float] = {}
+STARTUP_MILESTONES = [
+    ("loaded", "Seconds from process start until the buttons were loaded."),
+    ("connected", "Seconds from process start until the first gateway READY."),
+    ("first_interaction", "Seconds from process start until the first click was answered."),
+]
+for milestone, description in STARTUP_MILESTONES:
+    Gauge(
+        f"channelbot_startup_{milestone}_seconds",
+        description,
+        lambda milestone=milestone: startup_times.get(milestone, math.nan),
+    )
+
+def mark_startup(milestone: str):
+    if milestone in startup_times:
+        return
+    startup_times[milestone] = time.perf_counter() - PROCESS_STARTED
+    logging.getLogger("channelbot").info(
+        "Startup: %s after %.0fms", milestone, startup_times[milestone] * 1000,
+        extra={"startup_milestone": milestone, "startup_seconds": startup_times[milestone]},
+    )
+
+class RateLimitCounter(logging.Handler):
+    """
+    py-cord retries 429 responses internally and only tells us about them by
+    logging, so count the log records.
+    """
 
-class Bot(commands.Bot):
-    async def setup_hook():
-        command_hook.start()
+    def emit(self, record: logging.LogRecord):
+        if record.msg.startswith("We are being rate limited"):
+            REST_RATE_LIMITED.inc()
+
+def instrument_http(http: discord.http.HTTPClient):
+    """
+    Count every REST request made through py-cord, by method and the route's
+    path template (e.g. /channels/{channel_id}/messages).
+    """
+    request = http.request
+
+    async def counted_request(route: discord.http.Route, **kwargs):
+        REST_REQUESTS.inc(method=route.method, route=route.path)
+        return await request(route, **kwargs)
+
+    http.request = counted_request
+    logging.getLogger("discord.http").addHandler(RateLimitCounter(logging.WARNING))
+
+def readiness_problems() -> List[str]:
+    """
+    The things still warming up, if any. The bot is ready to take traffic
+    once this is empty.
+    """
+    problems = []
+    if not bot.is_ready():
+        problems.append("gateway not connected")
+    if not action_index.actions:
+        problems.append("no buttons loaded")
+    if STATUS_PREFETCH_INTERVAL > 0 and any(url not in status_cache for _, url in STATUS_SERVICES):
+        problems.append("status cache cold")
+    if settings.suggestions is not None and suggestion_reactor.emojis is None:
+        problems.append("suggestion emojis not resolved")
+    return problems
+
+async def start_metrics_server(port: int) -> "aiohttp.web.AppRunner":
+    # Only imported if the server is enabled
+    import aiohttp.web
+
+    async def handle_metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.Response(text=render_metrics(), content_type="text/plain")
+
+    async def handle_ready(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        problems = readiness_problems()
+        if problems:
+            return aiohttp.web.Response(status=503, text="\n".join(problems) + "\n")
+        return aiohttp.web.Response(text="ready\n")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/readyz", handle_ready)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, "0.0.0.0", port).start()
+    metrics_log.info("Serving metrics on port %d", port)
+    return runner
+
+"""
+State shared between bot processes, so that several replicas (or the old and
+new pods during a rolling restart) coordinate instead of each handling the
+same honeypot trigger, command or daily domain check.
+
+The one primitive is claim(): take a key for `ttl` seconds unless another
+instance already holds it. It doubles as a dedupe set (claim each event once)
+and as a leader lease (re-claim before it expires to stay leader). Cached
+values can be shared with get()/set().
+
+Set SHARED_STATE to "sqlite:<path>" to share a SQLite file between processes
+on the same host/volume. The default, "memory", keeps everything in-process,
+which behaves exactly like a single bot did before.
+"""
+SHARED_STATE = os.environ.get("SHARED_STATE", "memory")
+# Identifies this process as the holder of claims; the pod name under k8s
+INSTANCE_ID = os.environ.get("INSTANCE_ID", f"{socket.gethostname()}-{os.getpid()}")
+
+class SharedState:
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        """
+        Take `key` for `ttl` seconds. Returns True if it was free (or expired),
+        or already held by `owner`, in which case the claim is renewed.
+        """
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """
+        Returns the value stored at `key` and the time.time() it was set at,
+        or None if there is none or it expired.
+        """
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: float):
+        raise NotImplementedError
+
+class MemorySharedState(SharedState):
+    def __init__(self):
+        # key -> (owner, expires at); key -> (value, set at, expires at)
+        self.claims: Dict[str, Tuple[str, float]] = {}
+        self.values: Dict[str, Tuple[str, float, float]] = {}
+        self.last_pruned = 0.0
+
+    def prune(self, now: float):
+        if now - self.last_pruned < 60:
+            return
+        self.last_pruned = now
+        for key in [key for key, (_, expires_at) in self.claims.items() if expires_at <= now]:
+            del self.claims[key]
+        for key in [key for key, (_, _, expires_at) in self.values.items() if expires_at <= now]:
+            del self.values[key]
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        self.prune(now)
+        holder = self.claims.get(key, None)
+        if holder is not None and holder[1] > now and holder[0] != owner:
+            return False
+        self.claims[key] = (owner, now + ttl)
+        return True
+
+    async def get(self, key: str) -> Optional[Tuple[str, float]]:
+        entry = self.values.get(key, None)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    async def set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        self.prune(now)
+        self.values[key] = (value, now, now + ttl)
+
+class SQLiteSharedState(SharedState):
+    """
+    Shared state in a SQLite file. All queries run on one dedicated thread
+    (which owns the connection), so the event loop never waits on the disk or
+    on another process holding the database lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self.last_pruned = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            # Autocommit, so each statement below is its own transaction
+            self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, set_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self.connection
+
+    def prune(self, connection: sqlite3.Connection, now: float):
+        if now - self.last_pruned < 60:
+            return
+        self.last_pruned = now
+        connection.execute("DELETE FROM claims WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    def claim_sync(self, key: str, owner: str, ttl: float) -> bool:
+        connection = self.connect()
+        now = time.time()
+        self.prune(connection, now)
+        # A single upsert, so two processes racing for the same key can't
+        # both win
+        cursor = connection.execute(
+            "INSERT INTO claims (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE claims.expires_at <= ? OR claims.owner = excluded.owner",
+            (key, owner, now + ttl, now),
+        )
+        return cursor.rowcount > 0
+
+    def get_sync(self, key: str) -> Optional[Tuple[str, float]]:
+        row = self.connect().execute(
+            "SELECT value, set_at FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def set_sync(self, key: str, value: str, ttl: float):
+        connection = self.connect()
+        now = time.time()
+        self.prune(connection, now)
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, set_at, expires_at) VALUES (?, ?, ?, ?)",
+            (key, value, now, now + ttl),
+        )
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        return await self.run(self.claim_sync, key, owner, ttl)
+
+    async def get(self, key: str) -> Optional[Tuple[str, float]]:
+        return await self.run(self.get_sync, key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self.run(self.set_sync, key, value, ttl)
+
+def open_shared_state(spec: str) -> SharedState:
+    if spec == "memory":
+        return MemorySharedState()
+    if spec.startswith("sqlite:"):
+        return SQLiteSharedState(spec[len("sqlite:"):])
+    raise ValueError(f"Unknown SHARED_STATE {spec!r}, expected 'memory' or 'sqlite:<path>'")
+
+shared_state = open_shared_state(SHARED_STATE)
+
+"""
+Set AUTO_SHARD=1 to run as an AutoShardedBot. Discord picks the shard count
+unless SHARD_COUNT is set; SHARD_IDS (comma-separated) limits this process to
+some of the shards, so they can be split across several processes.
+"""
+AUTO_SHARD = os.environ.get("AUTO_SHARD", "") not in ("", "0")
+shard_options = {}
+if AUTO_SHARD and "SHARD_COUNT" in os.environ:
+    shard_options["shard_count"] = int(os.environ["SHARD_COUNT"])
+if AUTO_SHARD and "SHARD_IDS" in os.environ:
+    shard_options["shard_ids"] = [int(shard_id) for shard_id in os.environ["SHARD_IDS"].split(",")]
+
+class Bot(commands.AutoShardedBot if AUTO_SHARD else commands.Bot):
+    async def setup_hook(self):
+        """
+        Start the background loops before connecting to the gateway, so they
+        are warm by the time events come in. py-cord doesn't call this itself
+        (unlike discord.py), so start() does.
+        """
+        if not watch_message_files.is_running():
+            watch_message_files.start()
+
+        if not flush_audit_log.is_running():
+            flush_audit_log.start()
+
+        if STATUS_PREFETCH_INTERVAL > 0 and not prefetch_service_status.is_running():
+            prefetch_service_status.start()
+
+        # Waits for the gateway itself
+        if DOMAIN_CHECK_DOMAINS and not check_domains.is_running():
+            check_domains.start()
+
+    async def start(self, *args, **kwargs):
+        if "PORT" in os.environ:
+            self.metrics_runner = await start_metrics_server(int(os.environ["PORT"]))
+        await self.setup_hook()
+        await super().start(*args, **kwargs)
+
+    async def process_commands(self, message: discord.Message):
+        if message.author.bot:
+            return
+        ctx = await self.get_context(message)
+        # Every replica sees the command, but only one should run it
+        if ctx.command is not None and not await shared_state.claim(f"command:{message.id}", INSTANCE_ID, 60 * 60):
+            return
+        await self.invoke(ctx)
+
+    async def close(self):
+        await audit_store.flush()
+        if http_session is not None:
+            await http_session.close()
+        if getattr(self, "metrics_runner", None) is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
 
 bot_intents = discord.Intents.default()
 bot_intents.members = True
 bot_intents.message_content = True
 
-bot = Bot(command_prefix=commands.when_mentioned_or("§"), intents=bot_intents)
+bot = Bot(command_prefix=commands.when_mentioned_or("§"), intents=bot_intents, **shard_options)
+instrument_http(bot.http)
+
+@bot.event
+async def on_ready():
+    logging.getLogger("channelbot").info("Logged in to Discord as %s", bot.user)
+
+    # We may have missed messages while disconnected, so don't trust the
+    # recent message index for anything sent before now
+    recent_messages.started_at = discord.utils.utcnow()
+    mark_startup("connected")
+
+    if settings.suggestions is not None:
+        suggestion_reactor.start(settings.suggestions)
 
-def construct_filename_from_custom_id(custom_id: str) -> str:
+MESSAGES_DIR = "messages"
+
+class ButtonAction(NamedTuple):
     """
-    Find the relevant XML file from an action ID.
-    Does not verify whether the file exists.
+    A pre-parsed "action" attribute of a <button>. `source` is the name of the
+    XML file (without extension) the button was found in, which scopes any
+    uniqueness group.
     """
-    return f"messages/{custom_id.split('_')[0]}.xml"
+    kind: str
+    target_id: int
+    unique_group: Optional[str]
+    source: str
 
-@bot.event
-async def on_ready():
-    print(f"Logged in to Discord as {bot.user}")
+class ActionIndex(NamedTuple):
+    """
+    In-memory lookup tables for button interactions, built once from the XML
+    files so that a click does no file I/O or XML parsing.
 
-def get_action_for_id(filename: str, custom_id: str) -> Optional[str]:
+    `actions` maps a button's custom_id to its parsed action, and
+    `unique_groups` maps (source, group name) to all role IDs in that group.
     """
-    From a custom_id of an action, find the relevant <button> that triggered this
-    within the XML at the path. Then, return the contents of the "action"
-    attribute.
+    actions: Dict[str, ButtonAction]
+    unique_groups: Dict[Tuple[str, str], List[int]]
 
-    Returns None if the button was not found, or if the button did not have an
-    "action" attribute.
+def parse_action(action_str: str, source: str) -> Optional[ButtonAction]:
     """
-    tree = ElementTree.parse(filename)
-    message_tag = tree.getroot()
-    for button_tag in message_tag.findall("./button"):
-        if button_tag.attrib.get("id", None) == custom_id:
-            return button_tag.attrib.get("action", None)
-    return None
+    Parse the contents of an "action" attribute into a ButtonAction.
 
-def get_unique_group_roles(filename: str, unique_group_name: str) -> List[int]:
+    Returns None if the action is malformed, of an unknown type, or has an ID
+    that can't be a Discord snowflake.
+    """
+    action = None
+    try:
+        if action_str.startswith("toggle-role:"):
+            # Toggles a role by ID, optionally with a uniqueness constraint
+            # Format: action="toggle-role:<ID>"
+            #         action="toggle-role:<GROUP>:<ID>"
+            parts = action_str.split(":")
+            if len(parts) == 2:
+                action = ButtonAction("toggle-role", int(parts[1]), None, source)
+            elif len(parts) == 3 and parts[1] != "":
+                action = ButtonAction("toggle-role", int(parts[2]), parts[1], source)
+        elif action_str.startswith("toggle-channel:"):
+            # Format: action="toggle-channel:<ID>"
+            action = ButtonAction("toggle-channel", int(action_str[15:]), None, source)
+    except ValueError:
+        return None
+
+    if action is None or not 0 < action.target_id < 2**64:
+        return None
+    return action
+
+class MessageFile(NamedTuple):
     """
-    Get the list of all role IDs for which there is a uniqueness constraint
-    in the provided group name. Only searches within the XML at the provided
-    filepath.
+    The buttons parsed out of a single XML file, along with the modification
+    time of the file when it was parsed.
     """
-    result: List[int] = []
+    mtime: float
+    actions: Dict[str, ButtonAction]
 
-    tree = ElementTree.parse(filename)
-    message_tag = tree.getroot()
+def parse_message_file(filename: str) -> MessageFile:
+    """
+    Parse all <button> tags in an XML file.
+
+    Raises ValueError if the file can't be parsed, or if any button is missing
+    an ID or has an invalid "action" attribute, so that a bad edit can be
+    rejected as a whole rather than partially applied.
+    """
+    # Not needed at all when starting from an up to date snapshot
+    import xml.etree.ElementTree as ElementTree
+
+    mtime = os.path.getmtime(filename)
+    source = os.path.splitext(os.path.basename(filename))[0]
+    XML_PARSES.inc()
+    try:
+        message_tag = ElementTree.parse(filename).getroot()
+    except ElementTree.ParseError as e:
+        raise ValueError(f"{filename} is not valid XML: {e}")
+
+    actions: Dict[str, ButtonAction] = {}
     for button_tag in message_tag.findall("./button"):
-        action_str = button_tag.attrib.get("action", "")
-        if action_str.startswith(f"toggle-role:{unique_group_name}:"):
-            result.append(int(action_str.split(":")[2]))
+        custom_id = button_tag.attrib.get("id", None)
+        if custom_id is None:
+            raise ValueError(f"A button in {filename} has no id")
+        if custom_id in actions:
+            raise ValueError(f"Button {custom_id} appears twice in {filename}")
 
-    return result
+        action = parse_action(button_tag.attrib.get("action", ""), source)
+        if action is None:
+            raise ValueError(f"Button {custom_id} in {filename} has an invalid action")
+        actions[custom_id] = action
 
-async def perform_action(
-    guild_id: Optional[int],
-    interaction: discord.Interaction,
-    action_str: str
-):
+    return MessageFile(mtime, actions)
+
+def build_action_index(message_files: Dict[str, MessageFile]) -> ActionIndex:
     """
-    Branch to either role-toggle or channel-toggle, and act upon them
-    accordingly. End with an ephemeral message with either an error or some
-    detailed success message.
+    Combine the parsed buttons of all XML files into a single ActionIndex.
+
+    Raises ValueError if the same button ID is used in more than one file.
     """
-    if guild_id is None:
-        return
+    actions: Dict[str, ButtonAction] = {}
+    unique_groups: Dict[Tuple[str, str], List[int]] = {}
 
-    guild = bot.get_guild(guild_id)
-    if guild is None or not isinstance(interaction.user, discord.Member):
-        return
+    for filename in sorted(message_files):
+        for custom_id, action in message_files[filename].actions.items():
+            if custom_id in actions:
+                raise ValueError(f"Button {custom_id} in {filename} is also defined in {actions[custom_id].source}")
+            actions[custom_id] = action
+            if action.unique_group is not None:
+                unique_groups.setdefault((action.source, action.unique_group), []).append(action.target_id)
 
+    return ActionIndex(actions, unique_groups)
 
-    if action_str.startswith("toggle-role:"):
-        # Toggles a role by ID, optionally with a uniqueness constraint
-        # Format: action="toggle-role:<ID>"
-        #         action="toggle-role:<GROUP>:<ID>"
+def reload_message_files(directory: str) -> bool:
+    """
+    Re-parse any XML files in the directory that were added or changed since
+    the last call, drop any that were deleted, and swap in a freshly built
+    ActionIndex.
 
-        if ":" in action_str[12:]:
-            # There is a unique group defined, so take the third bit as the ID
-            unique_group_name = action_str.split(":")[1]
-            target_role_id = action_str.split(":")[2]
-        else:
-            # If not, take the second part as the ID
-            unique_group_name = None
-            target_role_id = action_str.split(":")[1]
+    A changed file that fails validation is skipped, and its last good version
+    (if any) is kept. The new index is fully built before being assigned, so
+    interactions either see the old index or the new one, never a half-built
+    one.
 
-        # Verify the role exists in our cache
-        target_role = guild.get_role(int(target_role_id))
-        if target_role is None:
-            return
+    Returns True if the index was replaced.
+    """
+    global action_index
+
+    started = time.perf_counter()
+    filenames = set(glob.glob(os.path.join(directory, "*.xml")))
+
+    updated = {
+        filename: message_file
+        for filename, message_file in message_files.items()
+        if filename in filenames
+    }
+    changed = len(updated) != len(message_files)
+    for filename in set(rejected_message_files) - filenames:
+        del rejected_message_files[filename]
+
+    parsed: Dict[str, float] = {}
+    for filename in sorted(filenames):
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            # Deleted between the glob and now, pick it up next time
+            continue
 
-        current_roles = interaction.user.roles
+        previous = updated.get(filename, None)
+        if previous is not None and previous.mtime == mtime:
+            continue
+        if rejected_message_files.get(filename, None) == mtime:
+            # Already complained about this version of the file
+            continue
 
-        # If there was a uniqueness constraint for this role, we may need to
-        # remove some roles roles in this group.
-        removed_roles: List[discord.Role] = []
+        try:
+            updated[filename] = parse_message_file(filename)
+        except (OSError, ValueError) as e:
+            rejected_message_files[filename] = mtime
+            messages_log.warning("Not reloading %s: %s", filename, e)
+            continue
 
-        # Perform the update
-        if target_role in current_roles:
-            await interaction.user.remove_roles(target_role, reason="Self-selected", atomic=True)
-            # If we are removing a role, there are no constraint to worry about.
-        else:
-            await interaction.user.add_roles(target_role, reason="Self-selected", atomic=True)
-
-            # If we are adding a role, worry about any uniqueness constraint, and
-            # loop through all other roles in this group to unset them.
-            if unique_group_name is not None:
-                roles_in_group = get_unique_group_roles(construct_filename_from_custom_id(interaction.custom_id or ""), unique_group_name)
-
-                # Discard the one that we just added, since we don't want to be
-                # removing that
-                other_roles = [
-                    guild.get_role(role_id) for role_id in roles_in_group
-                    if role_id != int(target_role_id)
-                ]
-
-                # Discard any roles we couldn't find, or ones that the user doesn't
-                # have already. remove_roles() probably wouldn't complain if we try
-                # to remove a role that a user doesn't have, but we also need to
-                # keep track of what we really removed so we can put it in the
-                # response notice.
-                other_roles_filtered = [
-                    role for role in other_roles
-                    if role is not None and role in current_roles
-                ]
-                removed_roles.extend(other_roles_filtered)
-
-                await interaction.user.remove_roles(*other_roles_filtered, reason="Self-selected (uniqueness constraint)", atomic=True)
-
-        # Set the notice text
-        if target_role in current_roles:
-            # We previously had the target role, now no more
-            notice = f"Removed {target_role.mention} from you!"
-        else:
-            # We did not have the target role, now we do. This means we may have
-            # also removed some roles by the uniqueness constraint too.
-            notice = f"Added {target_role.mention} to you!"
-            if len(removed_roles) > 0:
-                notice += f" (Removed {', '.join(map(lambda x: x.mention, removed_roles))} due to uniqueness constraints.)"
-
-    elif action_str.startswith("toggle-channel:"):
-        # Toggles access to a channel, without any visible roles. This does not
-        # support uniqueness constraints, since querying each channel for permissions
-        # would take too long to be feasible.
-        # Format: action="toggle-channel:<ID>"
-
-        target_channel = guild.get_channel(int(action_str[15:]))
-        if target_channel is None:
-            return
+        rejected_message_files.pop(filename, None)
+        parsed[filename] = mtime
+        changed = True
+
+    if not changed:
+        return False
+
+    try:
+        new_index = build_action_index(updated)
+    except ValueError as e:
+        rejected_message_files.update(parsed)
+        messages_log.warning("Not reloading %s: %s", directory, e)
+        return False
+
+    message_files.clear()
+    message_files.update(updated)
+    action_index = new_index
+
+    elapsed = time.perf_counter() - started
+    ACTION_INDEX_RELOADS.inc()
+    ACTION_INDEX_RELOAD_SECONDS.observe(elapsed)
+    messages_log.info(
+        "Reloaded %s (%d buttons) in %.1fms", directory, len(new_index.actions), elapsed * 1000,
+        extra={"reload_seconds": elapsed},
+    )
+    return True
+
+# Parsed XML files by path, and the mtimes of versions that failed validation.
+# Only touched by reload_message_files().
+message_files: Dict[str, MessageFile] = {}
+rejected_message_files: Dict[str, float] = {}
+action_index = ActionIndex({}, {})
+
+"""
+The snapshot is a compact precompiled copy of the buttons in messages/, built
+by `python bot.py --compile-messages` when the Docker image is built. It holds
+only what the bot needs (no embeds), so startup doesn't parse any XML, and any
+malformed action fails the image build rather than a click. The XML files are
+still watched, and any that change after the snapshot was built are re-parsed
+as usual.
+"""
+ACTION_SNAPSHOT = os.environ.get("ACTION_SNAPSHOT", "messages.snapshot")
+# Bump whenever the snapshot layout or ButtonAction changes
+ACTION_SNAPSHOT_VERSION = 1
+
+def compile_action_snapshot(directory: str, path: str):
+    """
+    Strictly parse every XML file in the directory and write the snapshot.
+    Raises ValueError on any invalid file, action or duplicate button ID.
+    """
+    files = {
+        filename: parse_message_file(filename)
+        for filename in sorted(glob.glob(os.path.join(directory, "*.xml")))
+    }
+    index = build_action_index(files)
+
+    # Only plain builtin types, so it can be written with marshal
+    snapshot = {
+        "version": ACTION_SNAPSHOT_VERSION,
+        "files": {
+            filename: (message_file.mtime, [
+                (custom_id, action.kind, action.target_id, action.unique_group)
+                for custom_id, action in message_file.actions.items()
+            ])
+            for filename, message_file in files.items()
+        },
+    }
+    with open(path + ".tmp", "wb") as f:
+        marshal.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+    messages_log.info("Compiled %d buttons from %d files into %s", len(index.actions), len(files), path)
+
+def load_action_snapshot(path: str) -> bool:
+    """
+    Load the snapshot into message_files and swap in its ActionIndex. Returns
+    False (leaving everything untouched) if there is no usable snapshot.
+    """
+    global action_index
+
+    try:
+        with open(path, "rb") as f:
+            snapshot = marshal.load(f)
+        if snapshot.get("version", None) != ACTION_SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported version {snapshot.get('version', None)}")
+
+        files = {}
+        for filename, (mtime, buttons) in snapshot["files"].items():
+            source = os.path.splitext(os.path.basename(filename))[0]
+            files[filename] = MessageFile(mtime, {
+                custom_id: ButtonAction(kind, target_id, unique_group, source)
+                for custom_id, kind, target_id, unique_group in buttons
+            })
+        index = build_action_index(files)
+    except FileNotFoundError:
+        return False
+    except (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError) as e:
+        messages_log.warning("Ignoring unusable snapshot %s: %s", path, e)
+        return False
+
+    message_files.clear()
+    message_files.update(files)
+    action_index = index
+    messages_log.info("Loaded %d buttons from %s", len(index.actions), path)
+    return True
+
+# Start from the snapshot if there is one, then pick up any XML files that
+# are newer than it (or everything, if there's no snapshot)
+load_action_snapshot(ACTION_SNAPSHOT)
+reload_message_files(MESSAGES_DIR)
+mark_startup("loaded")
+
+MESSAGES_RELOAD_INTERVAL = float(os.environ.get("MESSAGES_RELOAD_INTERVAL", "10"))
+
+@tasks.loop(seconds=MESSAGES_RELOAD_INTERVAL)
+async def watch_message_files():
+    """
+    Poll messages/ for changes, so edits deployed by the update-discord-messages
+    workflow take effect without restarting the bot.
+    """
+    reload_message_files(MESSAGES_DIR)
+
+class SchedulerBusy(Exception):
+    """
+    Raised when a write can't be queued because its bucket is too backed up
+    to run it in time.
+    """
+
+class PendingWrite:
+    """
+    A queued write, along with the future its submitter is waiting on.
+    """
+
+    def __init__(self, serial: Hashable, operation: Callable[[], Awaitable[str]]):
+        self.serial = serial
+        self.operation = operation
+        self.future: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+class WriteScheduler:
+    """
+    Runs Discord writes (role edits, channel overwrites) through one queue
+    per rate-limit bucket, with at most `concurrency` writes per bucket in
+    flight. This keeps bursts of clicks on a popular button queued here, where
+    they can be measured and shed, rather than piling up as hidden 429
+    retries inside py-cord.
+
+    Writes with the same `serial` (same user) never run at the same time, so
+    they can't race each other. (Repeat clicks of the same button never get
+    this far; on_interaction has them wait on the first click instead.)
+
+    Clicks are deferred before their write is queued, so they can be answered
+    any time within the 15 minute life of the interaction token. A new write
+    is only rejected with SchedulerBusy if its estimated wait (writes ahead of
+    it, times the bucket's recent average write time, over `concurrency`) is
+    over `max_wait` seconds, or as a backstop if `max_depth` writes are
+    already queued.
+    """
+
+    def __init__(self, max_depth: int, max_wait: float, concurrency: int):
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.queues: Dict[Hashable, Deque[PendingWrite]] = {}
+        # Moving average of how long one write takes, per bucket. Kept after
+        # a bucket empties, as the best guess for its next burst
+        self.write_seconds: Dict[Hashable, float] = {}
+        # Number of running drain() tasks per bucket
+        self.workers: Dict[Hashable, int] = {}
+        # Locks are only kept alive while some write is holding or waiting
+        # on them
+        self.serial_locks: "weakref.WeakValueDictionary[Hashable, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def estimated_wait(self, bucket: Hashable) -> float:
+        """
+        Rough number of seconds a write submitted now to `bucket` would wait
+        before finishing.
+        """
+        queued = len(self.queues.get(bucket, ()))
+        return (queued + 1) * self.write_seconds.get(bucket, 0.0) / self.concurrency
+
+    def depth(self) -> int:
+        """
+        Total number of writes queued but not yet started, across all buckets.
+        """
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def submit(
+        self,
+        bucket: Hashable,
+        serial: Hashable,
+        operation: Callable[[], Awaitable[str]],
+    ) -> str:
+        """
+        Queue a write and wait for it to run, returning its result.
+        """
+        queue = self.queues.setdefault(bucket, deque())
+
+        if len(queue) >= self.max_depth or self.estimated_wait(bucket) > self.max_wait:
+            WRITES.inc(result="rejected")
+            raise SchedulerBusy()
+
+        pending = PendingWrite(serial, operation)
+        queue.append(pending)
+        if self.workers.get(bucket, 0) < self.concurrency:
+            self.workers[bucket] = self.workers.get(bucket, 0) + 1
+            asyncio.create_task(self.drain(bucket))
+
+        return await pending.future
+
+    async def drain(self, bucket: Hashable):
+        queue = self.queues[bucket]
+        try:
+            while queue:
+                pending = queue.popleft()
+                if pending.future.done():
+                    # The submitter was cancelled while waiting
+                    continue
+
+                WRITE_QUEUE_WAIT_SECONDS.observe(time.monotonic() - pending.queued_at)
+
+                lock = self.serial_locks.get(pending.serial, None)
+                if lock is None:
+                    lock = self.serial_locks[pending.serial] = asyncio.Lock()
+
+                try:
+                    async with lock:
+                        started = time.monotonic()
+                        try:
+                            result = await pending.operation()
+                        finally:
+                            took = time.monotonic() - started
+                            average = self.write_seconds.get(bucket, took)
+                            self.write_seconds[bucket] = 0.8 * average + 0.2 * took
+                except Exception as e:
+                    WRITES.inc(result="failed")
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                else:
+                    WRITES.inc(result="completed")
+                    if not pending.future.done():
+                        pending.future.set_result(result)
+        finally:
+            self.workers[bucket] -= 1
+            if self.workers[bucket] == 0:
+                del self.workers[bucket]
+                if not queue:
+                    del self.queues[bucket]
+
+write_scheduler = WriteScheduler(
+    max_depth=int(os.environ.get("WRITE_QUEUE_MAX_DEPTH", "5000")),
+    max_wait=float(os.environ.get("WRITE_QUEUE_MAX_WAIT", "600")),
+    concurrency=int(os.environ.get("WRITE_BUCKET_CONCURRENCY", "2")),
+)
 
-        # Use overwrites_for rather than permissions_for, since we want to query
-        # the permissions listed on the channel (not the overall resolution). So
-        # an admin could still "add" or "remove" themselves from the channel
-        # overwrite, despite already having see-it-all access.
-        current_permissions = target_channel.overwrites_for(interaction.user)
+"""
+Durable record of every role/channel toggle and moderation action, in an
+append-only SQLite database (AUDIT_LOG). Events are buffered in memory and
+written in batches on a dedicated thread, so nothing on the click path ever
+waits on the disk.
+"""
+AUDIT_LOG = os.environ.get("AUDIT_LOG", "audit.sqlite3")
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", "5"))
+# Flush early once this many events are waiting
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "100"))
+# If the disk can't keep up, the oldest unwritten events are dropped past this
+AUDIT_BUFFER_MAX = int(os.environ.get("AUDIT_BUFFER_MAX", "10000"))
+
+class AuditEvent(NamedTuple):
+    # Unix timestamp
+    at: float
+    guild_id: int
+    # Who did it: the member themselves for a toggle, a moderator for a
+    # report, or the bot for honeypot moderation
+    actor_id: int
+    # Who it was done to
+    user_id: int
+    # e.g. "role-added", "channel-left", "timed-out"; see AUDIT_TARGET_MENTIONS
+    kind: str
+    # The role or channel involved, if any
+    target_id: Optional[int]
+    detail: str
+
+# How to mention the target of each kind of event
+AUDIT_TARGET_MENTIONS = {
+    "role-added": "<@&{}>",
+    "role-removed": "<@&{}>",
+    "channel-joined": "<#{}>",
+    "channel-left": "<#{}>",
+    "reported": "in <#{}>",
+}
+
+class AuditLog:
+    def __init__(self, path: str, batch_size: int, buffer_max: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.buffer: Deque[AuditEvent] = deque(maxlen=buffer_max)
+        self.connection: Optional[sqlite3.Connection] = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit")
+        self.flushing: Optional[asyncio.Task] = None
+
+    def record(self, guild_id: int, actor_id: int, user_id: int, kind: str, target_id: Optional[int] = None, detail: str = ""):
+        """
+        Queue an event to be written. Never blocks.
+        """
+        if len(self.buffer) == self.buffer.maxlen:
+            AUDIT_EVENTS.inc(result="dropped")
+        self.buffer.append(AuditEvent(time.time(), guild_id, actor_id, user_id, kind, target_id, detail))
+        if len(self.buffer) >= self.batch_size:
+            self.flush_soon()
+
+    def flush_soon(self):
+        if self.flushing is None or self.flushing.done():
+            self.flushing = asyncio.create_task(self.flush())
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    at REAL NOT NULL,
+                    guild_id INTEGER NOT NULL,
+                    actor_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    target_id INTEGER,
+                    detail TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS events_by_user ON events (guild_id, user_id, at);
+                CREATE INDEX IF NOT EXISTS events_by_target ON events (guild_id, target_id, at);
+                CREATE INDEX IF NOT EXISTS events_by_time ON events (guild_id, at);
+                CREATE TRIGGER IF NOT EXISTS events_no_update BEFORE UPDATE ON events
+                    BEGIN SELECT RAISE(ABORT, 'the audit log is append-only'); END;
+                CREATE TRIGGER IF NOT EXISTS events_no_delete BEFORE DELETE ON events
+                    BEGIN SELECT RAISE(ABORT, 'the audit log is append-only'); END;
+            """)
+            self.connection = connection
+        return self.connection
+
+    def write(self, events: List[AuditEvent]):
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                "INSERT INTO events (at, guild_id, actor_id, user_id, kind, target_id, detail) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                events,
+            )
 
-        await target_channel.set_permissions(
-            target=interaction.user,
-            reason="Self-selected",
-            read_messages=not current_permissions.read_messages,
+    async def flush(self):
+        """
+        Write everything buffered so far in one transaction. If that fails,
+        the events go back on the front of the buffer for the next flush.
+        """
+        while self.buffer:
+            events = list(self.buffer)
+            self.buffer.clear()
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.write, events)
+            except sqlite3.Error as e:
+                audit_log.warning("Failed to write %d audit events: %s", len(events), e)
+                # Keep the newest events if there's no longer room for them all
+                kept = events + list(self.buffer)
+                dropped = len(kept) - self.buffer.maxlen
+                if dropped > 0:
+                    AUDIT_EVENTS.inc(dropped, result="dropped")
+                self.buffer = deque(kept, maxlen=self.buffer.maxlen)
+                return
+            AUDIT_EVENTS.inc(len(events), result="written")
+
+    def query_sync(
+        self,
+        guild_id: int,
+        user_id: Optional[int],
+        target_id: Optional[int],
+        since: float,
+        before: Optional[Tuple[float, int]],
+        limit: int,
+    ) -> List[Tuple[int, AuditEvent]]:
+        conditions = ["guild_id = ?", "at >= ?"]
+        params: List = [guild_id, since]
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if target_id is not None:
+            conditions.append("target_id = ?")
+            params.append(target_id)
+        if before is not None:
+            conditions.append("(at, id) < (?, ?)")
+            params.extend(before)
+        # Newest first in the same order as the indexes, so SQLite walks an
+        # index backwards instead of sorting
+        rows = self.connect().execute(
+            "SELECT id, at, guild_id, actor_id, user_id, kind, target_id, detail FROM events "
+            f"WHERE {' AND '.join(conditions)} ORDER BY at DESC, id DESC LIMIT ?",
+            params + [limit],
+        ).fetchall()
+        return [(row[0], AuditEvent(*row[1:])) for row in rows]
+
+    async def query(
+        self,
+        guild_id: int,
+        user_id: Optional[int] = None,
+        target_id: Optional[int] = None,
+        since: float = 0,
+        before: Optional[Tuple[float, int]] = None,
+        limit: int = 20,
+    ) -> List[Tuple[int, AuditEvent]]:
+        """
+        Newest first, paged by passing (at, ID) of the last event of the
+        previous page as `before`. Anything still buffered is written first, so a query
+        always sees every event recorded before it.
+        """
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.query_sync, guild_id, user_id, target_id, since, before, limit,
         )
 
-        # Set the notice text
-        if current_permissions.read_messages:
-            notice = f"You can no longer read messages in #{target_channel.name}!"
-        else:
-            notice = f"You can now read messages in {target_channel.mention}!"
+audit_store = AuditLog(AUDIT_LOG, AUDIT_BATCH_SIZE, AUDIT_BUFFER_MAX)
+
+@tasks.loop(seconds=AUDIT_FLUSH_INTERVAL)
+async def flush_audit_log():
+    await audit_store.flush()
+
+async def toggle_role(
+    guild: discord.Guild,
+    member: discord.Member,
+    action: ButtonAction,
+    index: ActionIndex
+) -> str:
+    """
+    Toggles a role by ID, optionally with a uniqueness constraint. Returns the
+    notice to show the user.
+    """
+    unique_group_name = action.unique_group
+    target_role_id = action.target_id
+
+    # Verify the role exists in our cache
+    target_role = guild.get_role(target_role_id)
+    if target_role is None:
+        return "That role no longer exists. Please re-check the bot configuration."
+
+    current_role_ids = {role.id for role in member.roles}
+    had_target_role = target_role_id in current_role_ids
+
+    # If there was a uniqueness constraint for this role, we may need to
+    # remove some roles roles in this group.
+    removed_roles: List[discord.Role] = []
+
+    # Perform the update
+    if had_target_role:
+        await member.remove_roles(target_role, reason="Self-selected", atomic=True)
+        # If we are removing a role, there are no constraint to worry about.
     else:
-        # The XML may have had an invalid action attribute
-        notice = f"Invalid action triggered. Please re-check the bot configuration."
+        # If we are adding a role, worry about any uniqueness constraint, and
+        # find all other roles in this group that the user has, to unset them.
+        if unique_group_name is not None:
+            roles_in_group = index.unique_groups.get((action.source, unique_group_name), [])
+
+            # Discard the one that we're adding, since we don't want to be
+            # removing that, and any roles we couldn't find or that the user
+            # doesn't have already. We need to keep track of what we really
+            # removed so we can put it in the response notice.
+            for role_id in roles_in_group:
+                if role_id != target_role_id and role_id in current_role_ids:
+                    role = guild.get_role(role_id)
+                    if role is not None:
+                        removed_roles.append(role)
+
+        if len(removed_roles) > 0:
+            # Swap the roles in a single request, so the user can never be
+            # left holding two roles of the same group if one call fails
+            removed_role_ids = {role.id for role in removed_roles}
+            await member.edit(
+                roles=[
+                    role for role in member.roles
+                    if not role.is_default() and role.id not in removed_role_ids
+                ] + [target_role],
+                reason="Self-selected (uniqueness constraint)",
+            )
+        else:
+            await member.add_roles(target_role, reason="Self-selected", atomic=True)
 
-    await interaction.response.send_message(
-        content=f"{notice}",
-        ephemeral=True
+    if had_target_role:
+        audit_store.record(guild.id, member.id, member.id, "role-removed", target_role_id)
+    else:
+        audit_store.record(guild.id, member.id, member.id, "role-added", target_role_id)
+        for role in removed_roles:
+            audit_store.record(guild.id, member.id, member.id, "role-removed", role.id, "uniqueness constraint")
+
+    # Set the notice text
+    if had_target_role:
+        # We previously had the target role, now no more
+        notice = f"Removed {target_role.mention} from you!"
+    else:
+        # We did not have the target role, now we do. This means we may have
+        # also removed some roles by the uniqueness constraint too.
+        notice = f"Added {target_role.mention} to you!"
+        if len(removed_roles) > 0:
+            notice += f" (Removed {', '.join(map(lambda x: x.mention, removed_roles))} due to uniqueness constraints.)"
+
+    return notice
+
+async def toggle_channel(
+    guild: discord.Guild,
+    member: discord.Member,
+    action: ButtonAction
+) -> str:
+    """
+    Toggles access to a channel, without any visible roles. This does not
+    support uniqueness constraints, since querying each channel for permissions
+    would take too long to be feasible. Returns the notice to show the user.
+    """
+    target_channel = guild.get_channel(action.target_id)
+    if target_channel is None:
+        return "That channel no longer exists. Please re-check the bot configuration."
+
+    # Use overwrites_for rather than permissions_for, since we want to query
+    # the permissions listed on the channel (not the overall resolution). So
+    # an admin could still "add" or "remove" themselves from the channel
+    # overwrite, despite already having see-it-all access.
+    current_permissions = target_channel.overwrites_for(member)
+
+    await target_channel.set_permissions(
+        target=member,
+        reason="Self-selected",
+        read_messages=not current_permissions.read_messages,
+    )
+    audit_store.record(
+        guild.id, member.id, member.id,
+        "channel-left" if current_permissions.read_messages else "channel-joined",
+        target_channel.id,
     )
 
+    # Set the notice text
+    if current_permissions.read_messages:
+        notice = f"You can no longer read messages in #{target_channel.name}!"
+    else:
+        notice = f"You can now read messages in {target_channel.mention}!"
+
+    return notice
+
+# Notices for a click that was shed because its bucket was full, and for one
+# whose action raised
+BUSY_NOTICE = "Lots of people are clicking right now! Please try again in a moment."
+FAILED_NOTICE = "Something went wrong, please try again later."
+
+async def perform_action(
+    guild: discord.Guild,
+    interaction: discord.Interaction,
+    action: Optional[ButtonAction],
+    index: ActionIndex
+) -> str:
+    """
+    Branch to either role-toggle or channel-toggle, and queue them on the
+    write scheduler accordingly. Returns the notice to show the user, with
+    either an error or some detailed success message.
+    """
+    started = time.perf_counter()
+    try:
+        member = interaction.user
+        if not isinstance(member, discord.Member):
+            return "Could not find you in this server."
+
+        try:
+            if action is not None and action.kind == "toggle-role":
+                # Discord rate limits role changes per guild
+                return await write_scheduler.submit(
+                    ("guild", guild.id),
+                    member.id,
+                    lambda: toggle_role(guild, member, action, index),
+                )
+            elif action is not None and action.kind == "toggle-channel":
+                # Discord rate limits permission overwrites per channel
+                return await write_scheduler.submit(
+                    ("channel", action.target_id),
+                    member.id,
+                    lambda: toggle_channel(guild, member, action),
+                )
+        except SchedulerBusy:
+            return BUSY_NOTICE
+
+        # The XML may have had an invalid action attribute
+        return "Invalid action triggered. Please re-check the bot configuration."
+    finally:
+        ACTION_SECONDS.observe(
+            time.perf_counter() - started,
+            action="invalid" if action is None else action.kind,
+        )
+
 @bot.event
 async def on_interaction(interaction: discord.Interaction):
     if not interaction.is_component():
         return
 
     if interaction.application_id != bot.application_id:
-        print("Interaction application ID didn't match")
+        interactions_log.debug("Interaction application ID didn't match", extra={"interaction_id": interaction.id})
         return
 
     custom_id = interaction.custom_id
     if custom_id is None:
-        print("Custom ID was None")
+        interactions_log.warning("Custom ID was None", extra={"interaction_id": interaction.id})
         return
 
-    action = get_action_for_id(construct_filename_from_custom_id(custom_id), custom_id)
-    await perform_action(interaction.guild_id, interaction, action)
+    guild = interaction.guild
+    if guild is None:
+        return
 
+    started = time.perf_counter()
+    log_fields = {
+        "interaction_id": interaction.id,
+        "guild_id": guild.id,
+        "user_id": interaction.user.id,
+        "custom_id": custom_id,
+    }
+
+    # Plain dictionary lookup; the XML was already parsed at startup. Hold on
+    # to this index for the whole interaction, in case it is swapped by a
+    # reload.
+    index = action_index
+    action = index.actions.get(custom_id, None)
+    ACTION_LOOKUPS.inc(result="miss" if action is None else "hit")
+    action_kind = "invalid" if action is None else action.kind
+
+    # Acknowledge straight away, so we never miss Discord's 3 second deadline
+    # however slow the role/permission updates below are
+    try:
+        await interaction.response.defer(ephemeral=True, invisible=False)
+    except discord.HTTPException as e:
+        if e.code == 40060:
+            # Already acknowledged, i.e. another replica is handling it. Only
+            # one can win, so this also stops a click being toggled twice.
+            interactions_log.debug("Interaction handled by another instance", extra=log_fields)
+        else:
+            interactions_log.warning("Failed to defer interaction: %s", e, extra=log_fields)
+        return
+
+    # Repeated clicks of the same button by the same user while the first is
+    # still being handled all wait on the first one, rather than toggling again
+    key = (interaction.user.id, custom_id)
+    task = interactions_in_flight.get(key, None)
+    if task is None:
+        task = asyncio.create_task(perform_action(guild, interaction, action, index))
+        interactions_in_flight[key] = task
+        task.add_done_callback(lambda _: interactions_in_flight.pop(key, None))
+
+    try:
+        notice = await asyncio.shield(task)
+    except Exception:
+        interactions_log.exception("Action failed", extra=log_fields)
+        notice = FAILED_NOTICE
+
+    try:
+        await interaction.followup.send(content=notice, ephemeral=True)
+    except discord.HTTPException as e:
+        interactions_log.warning("Failed to respond to interaction: %s", e, extra=log_fields)
+
+    INTERACTION_SECONDS.observe(time.perf_counter() - started, action=action_kind)
+    mark_startup("first_interaction")
+
+# (user ID, custom_id) -> the perform_action() task handling that click
+interactions_in_flight: Dict[Tuple[int, str], "asyncio.Task[str]"] = {}
+
+
+# Role lookups by name, keyed by (guild ID, name). Guilds only have a few
+# hundred roles at most, but this saves rescanning them on every command; the
+# entries for a guild are dropped whenever one of its roles changes.
+role_name_cache: Dict[Tuple[int, str], Optional[int]] = {}
+
+def get_role_named(guild: discord.Guild, name: str) -> Optional[discord.Role]:
+    key = (guild.id, name)
+    if key not in role_name_cache:
+        role = discord.utils.get(guild.roles, name=name)
+        role_name_cache[key] = role.id if role is not None else None
+    role_id = role_name_cache[key]
+    return guild.get_role(role_id) if role_id is not None else None
+
+def invalidate_role_names(guild: discord.Guild):
+    for key in [key for key in role_name_cache if key[0] == guild.id]:
+        del role_name_cache[key]
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    invalidate_role_names(role.guild)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    invalidate_role_names(role.guild)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    invalidate_role_names(after.guild)
+
+MEMBER_MENTION_PATTERN = re.compile(r"<@!?(\d+)>")
+
+def resolve_members(ctx, query: str) -> Tuple[List[discord.Member], List[str]]:
+    """
+    Resolve the members named in a command by mention or ID, using the
+    members the gateway already parsed out of the message's mentions and
+    then the guild's member cache. Both are dictionary lookups; names aren't
+    accepted, since the only way to find a member by name is to scan them all.
+    Returns the members found (without duplicates) and the arguments that
+    didn't match a member, including mentions of users who have left.
+    """
+    mentioned = {
+        mention.id: mention for mention in ctx.message.mentions
+        if isinstance(mention, discord.Member)
+    }
+
+    found: Dict[int, discord.Member] = {}
+    missing = []
+    for arg in query.split():
+        mention_match = MEMBER_MENTION_PATTERN.fullmatch(arg)
+        if mention_match is not None:
+            member_id = int(mention_match.group(1))
+        elif arg.isdigit():
+            member_id = int(arg)
+        else:
+            missing.append(arg)
+            continue
+
+        if member_id == bot.user.id:
+            continue
+        member = mentioned.get(member_id, None) or ctx.guild.get_member(member_id)
+        if member is None:
+            missing.append(arg)
+        else:
+            found[member.id] = member
+
+    return list(found.values()), missing
 
 @bot.command()
 @commands.has_permissions(manage_channels=True)
-async def report(ctx, *, member):
-    found = None
-    for guild_member in ctx.guild.members:
-        if guild_member.mentioned_in(ctx.message):
-            found = guild_member
-
+async def report(ctx, *, members):
+    found, missing = resolve_members(ctx, members)
+    if missing:
+        await ctx.send(f"Couldn't find {', '.join(f'`{arg}`' for arg in missing)} in guild.")
     if not found:
-        await ctx.send(f"Couldn't find `{member}` in guild.")
+        if not missing:
+            await ctx.send("Usage: `report <member mention or ID> ...`")
+        return
+
+    quarantined = get_role_named(ctx.guild, "quarantined")
+    if quarantined is None:
+        await ctx.send("Couldn't find the `quarantined` role in this guild.")
         return
 
-    print([r for r in ctx.guild.roles if r.name == "quarantined"][0])
+    reason = f"Reported by {ctx.author.name}#{ctx.author.discriminator}"
     channel = ctx.message.channel
-    await channel.set_permissions(
-        found,
-        reason=f"Reported by {ctx.author.name}#{ctx.author.discriminator}",
-        read_messages=False,
-    )
-    await found.edit(
-        reason=f"Reported by {ctx.author.name}#{ctx.author.discriminator}",
-        roles=[r for r in ctx.guild.roles if r.name == "quarantined"],
-    )
 
-    await ctx.send(
-        f"{found.mention} has been reported by {ctx.author.mention} — CC <@&315339680641974273>"
+    async def quarantine(member: discord.Member):
+        commands_log.info(
+            "%s reported by %s", member.name, ctx.author.name,
+            extra={"guild_id": ctx.guild.id, "user_id": member.id, "channel_id": ctx.channel.id},
+        )
+        await asyncio.gather(
+            channel.set_permissions(member, reason=reason, read_messages=False),
+            member.edit(reason=reason, roles=[quarantined]),
+        )
+        audit_store.record(ctx.guild.id, ctx.author.id, member.id, "reported", channel.id, "quarantined")
+
+    results = await asyncio.gather(
+        *(quarantine(member) for member in found), return_exceptions=True
     )
+    reported = []
+    for member, result in zip(found, results):
+        if isinstance(result, BaseException):
+            commands_log.error(
+                "Couldn't quarantine %s: %s", member.name, result,
+                extra={"guild_id": ctx.guild.id, "user_id": member.id},
+            )
+            await ctx.send(f"Couldn't quarantine {member.mention}: {result}")
+        else:
+            reported.append(member)
+
+    if reported:
+        await ctx.send(
+            f"{', '.join(member.mention for member in reported)} "
+            f"{'has' if len(reported) == 1 else 'have'} been reported by {ctx.author.mention}"
+            f" — CC <@&315339680641974273>"
+        )
+
+BULK_ROLE_BATCH_SIZE = int(os.environ.get("BULK_ROLE_BATCH_SIZE", "5"))
+BULK_ROLE_BATCH_DELAY = float(os.environ.get("BULK_ROLE_BATCH_DELAY", "1"))
+BULK_ROLE_CHECKPOINT_DIR = os.environ.get("BULK_ROLE_CHECKPOINT_DIR", ".")
+
+# Only one bulk role run at a time, so two can't fight over the same members
+bulk_role_lock = asyncio.Lock()
+
+def resolve_role(guild: discord.Guild, role_str: str) -> Optional[discord.Role]:
+    """
+    Find a role from a mention, an ID, the custom_id of a toggle-role button
+    (e.g. "year_1"), or a role name.
+    """
+    role_str = role_str.strip()
+    if role_str.startswith("<@&") and role_str.endswith(">"):
+        role_str = role_str[3:-1]
+    if role_str.isdigit():
+        return guild.get_role(int(role_str))
+
+    action = action_index.actions.get(role_str, None)
+    if action is not None and action.kind == "toggle-role":
+        return guild.get_role(action.target_id)
+
+    return get_role_named(guild, role_str)
+
+def bulk_role_checkpoint_path(guild_id: int, mapping: Dict[int, Optional[int]]) -> str:
+    key = ",".join(f"{source}={target}" for source, target in sorted(mapping.items()))
+    digest = hashlib.sha256(f"{guild_id}:{key}".encode()).hexdigest()[:16]
+    return os.path.join(BULK_ROLE_CHECKPOINT_DIR, f"bulkrole-{digest}.json")
+
+def load_bulk_role_checkpoint(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_bulk_role_checkpoint(path: str, checkpoint: dict):
+    # Write then rename, so an interrupted write can't lose the progress so far
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+def map_member_roles(member: discord.Member, mapping: Dict[int, Optional[int]]) -> Optional[List[int]]:
+    """
+    Work out a member's new role list from the roles they hold right now,
+    with every mapping applied at once, so chains like year 1 -> year 2 ->
+    year 3 move each member exactly one step. Roles outside the mapping are
+    kept as they are. Returns None if the member holds none of the mapped
+    roles.
+    """
+    role_ids = [role.id for role in member.roles if not role.is_default()]
+    if not any(role_id in mapping for role_id in role_ids):
+        return None
+
+    new_role_ids: List[int] = []
+    for role_id in role_ids:
+        new_role_id = mapping[role_id] if role_id in mapping else role_id
+        if new_role_id is not None and new_role_id not in new_role_ids:
+            new_role_ids.append(new_role_id)
+    return new_role_ids
+
+def bulk_role_removals(member: discord.Member, mapping: Dict[int, Optional[int]]) -> List[int]:
+    """
+    The mapped roles a member holds right now that moving them would take
+    away. Once they hold none of these, they have been moved.
+    """
+    new_role_ids = map_member_roles(member, mapping) or []
+    return [
+        role.id for role in member.roles
+        if role.id in mapping and role.id not in new_role_ids
+    ]
+
+@bot.command()
+@commands.has_permissions(manage_roles=True)
+async def bulkrole(ctx, *mappings: str):
+    """
+    Move members between roles in bulk, e.g. at the start of an academic year:
+        §bulkrole year_4=year_5 year_3=year_4 year_2=year_3 year_1=year_2 year_0=year_1
+    Each mapping is <from>=<to>, where a role is a mention, ID, button ID or
+    name, and <to> may be "none" to just remove the role. If a run is
+    interrupted, running the same command again resumes it.
+    """
+    guild = ctx.guild
+    if guild is None:
+        return
+
+    mapping: Dict[int, Optional[int]] = {}
+    for entry in mappings:
+        source_str, _, target_str = entry.partition("=")
+        source = resolve_role(guild, source_str)
+        target = None if target_str.strip().lower() == "none" else resolve_role(guild, target_str)
+        if source is None or (target is None and target_str.strip().lower() != "none"):
+            await ctx.send(f"Couldn't understand `{entry}`. Use `<from role>=<to role>` or `<from role>=none`.")
+            return
+        mapping[source.id] = None if target is None else target.id
+
+    if not mapping:
+        await ctx.send("Usage: `bulkrole <from role>=<to role> ...`")
+        return
+
+    if bulk_role_lock.locked():
+        await ctx.send("A bulk role change is already running, please wait for it to finish.")
+        return
+
+    async with bulk_role_lock:
+        path = bulk_role_checkpoint_path(guild.id, mapping)
+        checkpoint = await asyncio.to_thread(load_bulk_role_checkpoint, path)
+        resumed = checkpoint is not None
+        if checkpoint is None:
+            # The members to move are fixed when the run starts, along with
+            # the roles moving each one would remove. Members who pick up a
+            # mapped role later (e.g. by clicking into year 2 between runs)
+            # are left alone
+            checkpoint = {
+                "guild_id": guild.id,
+                "mapping": {str(source): target for source, target in mapping.items()},
+                "members": {
+                    str(member.id): bulk_role_removals(member, mapping)
+                    for member in guild.members
+                    if map_member_roles(member, mapping) is not None
+                },
+                "done": [],
+            }
+            await asyncio.to_thread(save_bulk_role_checkpoint, path, checkpoint)
+
+        # Members already moved may now hold a mapped role (e.g. year 2 after
+        # moving from year 1), so they must not be moved again
+        done = set(checkpoint["done"])
+        todo = [member_id for member_id in checkpoint["members"] if member_id not in done]
+        total = len(checkpoint["members"])
+        failed: Dict[str, str] = {}
+        progress = await ctx.send(
+            f"{'Resuming' if resumed else 'Starting'} bulk role change for {total} member(s), "
+            f"{len(todo)} to go..."
+        )
+        commands_log.info(
+            "Bulk role change by %s: %d member(s), %d to go", ctx.author.name, total, len(todo),
+            extra={"guild_id": guild.id, "user_id": ctx.author.id, "mapping": checkpoint["mapping"], "resumed": resumed},
+        )
+
+        async def apply(member: discord.Member):
+            member_id = str(member.id)
+            new_role_ids = map_member_roles(member, mapping)
+            if new_role_ids is None:
+                # Their mapped roles were removed since the run started
+                checkpoint["done"].append(member_id)
+                return
+            # One request with the roles as they are now, rather than separate
+            # add/remove calls, so a failure can't leave a member holding
+            # both the old and new role (and being moved twice on a retry)
+            roles = [role for role in map(guild.get_role, new_role_ids) if role is not None]
+            try:
+                await member.edit(roles=roles, reason=f"Bulk role change by {ctx.author.name}")
+            except discord.HTTPException as e:
+                failed[member_id] = str(e)
+                return
+            checkpoint["done"].append(member_id)
+
+        for i in range(0, len(todo), BULK_ROLE_BATCH_SIZE):
+            batch: List[discord.Member] = []
+            for member_id in todo[i:i + BULK_ROLE_BATCH_SIZE]:
+                member = guild.get_member(int(member_id))
+                if member is None:
+                    failed[member_id] = "left the server"
+                    continue
+                removals = checkpoint["members"][member_id]
+                if not any(role.id in removals for role in member.roles):
+                    # Moved already: their edit landed just before the last
+                    # run was interrupted, or they changed roles themselves
+                    checkpoint["done"].append(member_id)
+                    continue
+                # Record what they hold right before the edit, so a resume
+                # after an interruption mid-batch can tell if it landed
+                checkpoint["members"][member_id] = bulk_role_removals(member, mapping)
+                batch.append(member)
+            await asyncio.to_thread(save_bulk_role_checkpoint, path, checkpoint)
+
+            await asyncio.gather(*[apply(member) for member in batch])
+            await asyncio.to_thread(save_bulk_role_checkpoint, path, checkpoint)
+
+            handled = len(checkpoint["done"]) + len(failed)
+            if (i // BULK_ROLE_BATCH_SIZE) % 10 == 0:
+                try:
+                    await progress.edit(content=f"Bulk role change: {handled}/{total} member(s) done...")
+                except discord.HTTPException:
+                    pass
+            # Leave room in the guild's member rate limit bucket for clicks
+            await asyncio.sleep(BULK_ROLE_BATCH_DELAY)
+
+        if failed:
+            # Keep the checkpoint, so running the command again retries the
+            # failures (they aren't in "done")
+            commands_log.warning(
+                "Bulk role change failed for %d member(s)", len(failed),
+                extra={"guild_id": guild.id, "failed": failed},
+            )
+        else:
+            await asyncio.to_thread(os.remove, path)
+
+    summary = f"Bulk role change done: moved {len(checkpoint['done'])}/{total} member(s)."
+    if failed:
+        summary += f" {len(failed)} failed; run the same command again to retry them."
+    await progress.edit(content=summary)
+
+AUDIT_PAGE_SIZE = 15
+# Pages sent per command before asking for a narrower query
+AUDIT_MAX_PAGES = int(os.environ.get("AUDIT_MAX_PAGES", "5"))
+CHANNEL_MENTION_PATTERN = re.compile(r"<#(\d+)>")
+
+def format_audit_event(event: AuditEvent) -> str:
+    target = ""
+    if event.target_id is not None:
+        target = " " + AUDIT_TARGET_MENTIONS.get(event.kind, "{}").format(event.target_id)
+    actor = "" if event.actor_id == event.user_id else f" by <@{event.actor_id}>"
+    detail = f" ({event.detail})" if event.detail else ""
+    return f"<t:{int(event.at)}:f> <@{event.user_id}> {event.kind}{target}{actor}{detail}"
+
+def resolve_audit_subject(guild: discord.Guild, subject: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Work out whether an audit query is about a member (returns their ID as
+    the first item) or a role or channel (returns its ID as the second).
+    An ID that matches nothing is taken to be a member who has since left.
+    """
+    channel_match = CHANNEL_MENTION_PATTERN.fullmatch(subject)
+    if channel_match is not None:
+        return None, int(channel_match.group(1))
+
+    member_match = MEMBER_MENTION_PATTERN.fullmatch(subject)
+    if member_match is not None:
+        return int(member_match.group(1)), None
+
+    role = resolve_role(guild, subject)
+    if role is not None:
+        return None, role.id
+
+    if subject.isdigit():
+        if guild.get_channel(int(subject)) is not None:
+            return None, int(subject)
+        return int(subject), None
+
+    member = guild.get_member_named(subject)
+    if member is not None:
+        return member.id, None
+
+    channel = discord.utils.get(guild.channels, name=subject.lstrip("#"))
+    if channel is not None:
+        return None, channel.id
+
+    return None, None
+
+@bot.command()
+@commands.has_permissions(view_audit_log=True)
+async def audit(ctx, subject: str, days: float = 7):
+    """
+    Show the audit log for a member, role or channel over the last few days,
+    newest first, e.g. who opted into a channel this week:
+        §audit #gaming 7
+    """
+    guild = ctx.guild
+    if guild is None:
+        return
+
+    user_id, target_id = resolve_audit_subject(guild, subject)
+    if user_id is None and target_id is None:
+        await ctx.send(f"Couldn't find a member, role or channel called `{subject}`.")
+        return
+
+    since = time.time() - days * 24 * 60 * 60
+    no_mentions = discord.AllowedMentions.none()
+    before = None
+    for page in range(AUDIT_MAX_PAGES):
+        rows = await audit_store.query(guild.id, user_id, target_id, since, before, AUDIT_PAGE_SIZE)
+        if not rows:
+            if page == 0:
+                await ctx.send(f"Nothing in the audit log for `{subject}` in the last {days:g} days.")
+            return
+
+        # Send each page as soon as it's read, rather than after the last one
+        await ctx.send("\n".join(format_audit_event(event) for _, event in rows), allowed_mentions=no_mentions)
+        if len(rows) < AUDIT_PAGE_SIZE:
+            return
+        before = (rows[-1][1].at, rows[-1][0])
+
+    await ctx.send(f"Stopped after {AUDIT_MAX_PAGES} pages; ask for fewer days to see older events.")
 
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.errors.CheckFailure):
-        print(
-            f"Check condition failed. Command: '{ctx.command}', Channel: '{ctx.channel}', Channel ID: '{ctx.channel.id}'"
+        commands_log.info(
+            "Check condition failed. Command: '%s', Channel: '%s'", ctx.command, ctx.channel,
+            extra={"channel_id": ctx.channel.id, "user_id": ctx.author.id},
         )
     else:
-        print(f"Ignoring exception in command {ctx.command}:", file=sys.stderr)
-        traceback.print_exception(
-            type(error), error, error.__traceback__, file=sys.stderr
+        commands_log.error(
+            "Ignoring exception in command %s", ctx.command,
+            exc_info=(type(error), error, error.__traceback__),
+            extra={"channel_id": ctx.channel.id, "user_id": ctx.author.id},
         )
 
 
 """
 Domain checker checks our "core domains" for expiry dates.
 
-Runs every 24 hours to check our core domains.
+Runs every 24 hours to check our core domains. The whois lookups run in a
+thread pool, all at once with a timeout each, and their results are cached on
+disk so a restart doesn't re-query everything.
 """
+DOMAIN_CHECK_DOMAINS = [
+    domain.strip()
+    for domain in os.environ.get(
+        "DOMAIN_CHECK_DOMAINS",
+        "comp-soc.com,hacktheburgh.com,betterinformatics.com",
+    ).split(",")
+    if domain.strip()
+]
+DOMAIN_CHECK_TIMEOUT = float(os.environ.get("DOMAIN_CHECK_TIMEOUT", "30"))
+DOMAIN_CHECK_CACHE = os.environ.get("DOMAIN_CHECK_CACHE", "domain-expiry-cache.json")
+DOMAIN_CHECK_CACHE_TTL = float(os.environ.get("DOMAIN_CHECK_CACHE_TTL", str(60*60*20)))
+
+class DomainInfo(NamedTuple):
+    # Unix timestamps; expiration is None if whois didn't return one
+    checked_at: float
+    expiration: Optional[float]
+    registrar: Optional[str]
+
+whois_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="whois")
+
+def whois_lookup(domain: str) -> DomainInfo:
+    """
+    Blocking whois query for a domain. Run this in whois_executor.
+    """
+    # Only needed once a day, so it isn't imported at startup
+    import whois
+
+    w = whois.whois(domain)
+    expiration = w.expiration_date
+    if isinstance(expiration, list):
+        # Some registries return several dates; the earliest is the one to worry about
+        expiration = min(expiration) if expiration else None
+    return DomainInfo(
+        time.time(),
+        expiration.timestamp() if isinstance(expiration, datetime) else None,
+        w.registrar or None,
+    )
+
+def load_domain_cache(path: str) -> Dict[str, DomainInfo]:
+    try:
+        with open(path) as f:
+            return {domain: DomainInfo(*info) for domain, info in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError) as e:
+        domains_log.warning("Ignoring unreadable domain cache %s: %s", path, e)
+        return {}
+
+def save_domain_cache(path: str, cache: Dict[str, DomainInfo]):
+    # Write then rename, so a crash never leaves a half-written cache behind
+    with open(path + ".tmp", "w") as f:
+        json.dump({domain: list(info) for domain, info in cache.items()}, f)
+    os.replace(path + ".tmp", path)
+
+async def lookup_domain(domain: str, cache: Dict[str, DomainInfo]) -> Optional[DomainInfo]:
+    """
+    Get whois info for a domain from the cache if it is recent enough,
+    otherwise look it up in the thread pool. Returns None if the lookup failed
+    or timed out.
+    """
+    cached = cache.get(domain, None)
+    if cached is not None and time.time() - cached.checked_at < DOMAIN_CHECK_CACHE_TTL:
+        return cached
+
+    loop = asyncio.get_running_loop()
+    try:
+        info = await asyncio.wait_for(
+            loop.run_in_executor(whois_executor, whois_lookup, domain),
+            timeout=DOMAIN_CHECK_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        domains_log.warning("whois lookup for %s timed out", domain)
+        return None
+    except Exception:
+        domains_log.exception("whois lookup for %s failed", domain)
+        return None
+
+    cache[domain] = info
+    return info
+
+# Whoever claims this first each day runs the check. It's a bit shorter than
+# the loop interval, so the lease has always expired by the holder's next run
+# but not by the time any other replica's daily run comes round.
+DOMAIN_CHECK_LEASE = 60*60*23
+
 @tasks.loop(seconds=60*60*24)
 async def check_domains():
-    domains = [
-        "comp-soc.com",
-        "hacktheburgh.com",
-        "betterinformatics.com",
-    ]
-
     await bot.wait_until_ready()
-    guild = await bot.fetch_guild(315277951597936640)
+    if not await shared_state.claim("leader:check_domains", INSTANCE_ID, DOMAIN_CHECK_LEASE):
+        domains_log.debug("Another instance is checking domains today")
+        return
+
+    guild = bot.get_guild(315277951597936640) or await bot.fetch_guild(315277951597936640)
     if not guild:
-        print("Failed to get guild, exiting")
+        domains_log.warning("Failed to get guild, exiting")
         return
 
-    # Check expiry on each domain by making whois queries
+    # Check expiry on each domain by making whois queries, all at once
+    cache = await asyncio.to_thread(load_domain_cache, DOMAIN_CHECK_CACHE)
+    infos = await asyncio.gather(*[
+        lookup_domain(domain, cache) for domain in DOMAIN_CHECK_DOMAINS
+    ])
+    try:
+        await asyncio.to_thread(save_domain_cache, DOMAIN_CHECK_CACHE, cache)
+    except OSError as e:
+        domains_log.warning("Failed to save domain cache %s: %s", DOMAIN_CHECK_CACHE, e)
+
     messages = []
     is_critical_notification = False
-    for domain in domains:
-        w = whois.query(domain)
-        if not w.expiration_date:
+    for domain, info in zip(DOMAIN_CHECK_DOMAINS, infos):
+        if info is None or info.expiration is None:
             continue
 
         # Check expiration timestamp and start building message
         to_notify = False
-        expiration_unix_timestamp = w.expiration_date.timestamp()
-        if expiration_unix_timestamp < time.time():
+        if info.expiration < time.time():
             messages.append(f"**Domain {domain} has expired!**")
             is_critical_notification, to_notify = True, True
-        elif expiration_unix_timestamp < (time.time() - 60*60*24*31):
-            messages.append(f"Domain {domain} will expire in <31 days. Please renew before {w.expiration_date}.")
+        elif info.expiration < (time.time() + 60*60*24*31):
+            messages.append(f"Domain {domain} will expire in <31 days. Please renew before <t:{int(info.expiration)}:D>.")
             to_notify = True
 
         # Add registrar to the message if it's available
-        if to_notify and w.registrar:
-            messages.append(f"According to my whois lookup {domain}'s registrar is '{w.registrar}'")
+        if to_notify and info.registrar:
+            messages.append(f"According to my whois lookup {domain}'s registrar is '{info.registrar}'")
 
     # Only send discord message if a message has actually been generated
     if messages:
@@ -338,14 +2123,14 @@ async def check_domains():
                     )
                 ],
             )
-        except discord.ext.commands.MissingPermissions:
+        except discord.Forbidden:
             # If I fail, try to send in a randomly chosen channel
             # I'd prefer to avoid infinite loops, so I won't attempt to send again if this fails, but it should try again tomorrow
             channel = random.choice(
                 guild.text_channels
             )  # Randomly select a channel to send notification in
             message_content += (
-                b"\n Note: I attempted to send this in another channel, which failed."
+                "\n Note: I attempted to send this in another channel, which failed."
             )
             await channel.send(
                 embeds=[
@@ -366,41 +2151,161 @@ async def check_domains():
 @check_domains.after_loop
 async def on_check_domains_cancel():
     if check_domains.failed():
-        time.sleep(60 * 60)
+        # Back off without blocking the event loop (and with it, the whole bot)
+        await asyncio.sleep(60 * 60)
         check_domains.restart()
 
 
+def parse_status_services(services_str: str) -> List[Tuple[str, str]]:
+    """
+    Parse a comma-separated list of "<Name>=<URL>" pairs into (name, url)
+    tuples, in the order they should be shown.
+    """
+    services: List[Tuple[str, str]] = []
+    for entry in services_str.split(","):
+        if "=" not in entry:
+            continue
+        name, url = entry.split("=", 1)
+        services.append((name.strip(), url.strip()))
+    return services
+
+STATUS_SERVICES = parse_status_services(os.environ.get(
+    "STATUS_SERVICES",
+    "MyEd=https://www.myed.ed.ac.uk/myed-progressive/,Learn=https://www.learn.ed.ac.uk/",
+))
+STATUS_PROBE_TIMEOUT = float(os.environ.get("STATUS_PROBE_TIMEOUT", "5"))
+
+class ProbeResult(NamedTuple):
+    up: bool
+    # Status code or connection error if the service is down, otherwise None
+    reason: Optional[str]
+
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Get the HTTP client shared by all outgoing non-Discord requests, creating
+    it on first use so it is bound to the running event loop. Connections are
+    pooled and kept alive between probes.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=4),
+            timeout=aiohttp.ClientTimeout(total=STATUS_PROBE_TIMEOUT),
+        )
+    return http_session
+
+async def probe_service(url: str) -> ProbeResult:
+    """
+    Check whether a service responds with 200 OK.
+    """
+    started = time.perf_counter()
+    try:
+        async with get_http_session().get(url) as response:
+            # check if the status code is 200
+            if response.status == 200:
+                return ProbeResult(True, None)
+            return ProbeResult(False, "Status: " + str(response.status))
+    except asyncio.TimeoutError:
+        return ProbeResult(False, f"Timed out after {STATUS_PROBE_TIMEOUT:g}s")
+    except aiohttp.ClientError as e:
+        # some connection error e.g. name not resolved
+        return ProbeResult(False, str(e) or type(e).__name__)
+    finally:
+        STATUS_PROBE_SECONDS.observe(time.perf_counter() - started, service=url)
+
+STATUS_CACHE_TTL = float(os.environ.get("STATUS_CACHE_TTL", "30"))
+# Set to a positive number of seconds to keep the status cache warm in the
+# background, so replies never wait on a probe. Disabled by default.
+STATUS_PREFETCH_INTERVAL = float(os.environ.get("STATUS_PREFETCH_INTERVAL", "0"))
+
+class CachedProbe(NamedTuple):
+    result: ProbeResult
+    # time.monotonic() at which the probe finished
+    checked_at: float
+
+# Last probe result per URL, and the probe currently running per URL (if any)
+status_cache: Dict[str, CachedProbe] = {}
+status_probes_in_flight: Dict[str, "asyncio.Task[ProbeResult]"] = {}
+
+async def refresh_service_status(url: str) -> ProbeResult:
+    """
+    Probe a service and store the result in the status cache.
+    """
+    result = await probe_service(url)
+    status_cache[url] = CachedProbe(result, time.monotonic())
+    await shared_state.set(f"status:{url}", json.dumps(result), STATUS_CACHE_TTL)
+    return result
+
+async def get_service_status(url: str) -> ProbeResult:
+    """
+    Get the status of a service, from the cache if it was probed within the
+    last STATUS_CACHE_TTL seconds. Otherwise probe it, sharing the probe with
+    any other callers that ask for the same URL while it is running, so a
+    flood of "is learn down" messages results in a single request.
+    """
+    cached = status_cache.get(url, None)
+    if cached is not None and time.monotonic() - cached.checked_at < STATUS_CACHE_TTL:
+        STATUS_LOOKUPS.inc(result="cached")
+        return cached.result
+
+    # Another replica may have probed it recently
+    shared = await shared_state.get(f"status:{url}")
+    if shared is not None:
+        value, set_at = shared
+        result = ProbeResult(*json.loads(value))
+        status_cache[url] = CachedProbe(result, time.monotonic() - (time.time() - set_at))
+        STATUS_LOOKUPS.inc(result="shared")
+        return result
+
+    task = status_probes_in_flight.get(url, None)
+    if task is not None:
+        STATUS_LOOKUPS.inc(result="joined")
+    else:
+        STATUS_LOOKUPS.inc(result="probed")
+        task = asyncio.create_task(refresh_service_status(url))
+        status_probes_in_flight[url] = task
+        task.add_done_callback(lambda _: status_probes_in_flight.pop(url, None))
+
+    # Shield the shared probe, so one waiter being cancelled doesn't cancel it
+    # for everyone else
+    return await asyncio.shield(task)
+
+@tasks.loop(seconds=STATUS_PREFETCH_INTERVAL or STATUS_CACHE_TTL)
+async def prefetch_service_status():
+    """
+    Re-probe all services on a fixed interval, independently of how many
+    people are asking.
+    """
+    await asyncio.gather(*[
+        refresh_service_status(url) for _, url in STATUS_SERVICES
+    ])
+
+# Check if the message is a status check via a very simple:tm: regex
+# thx regex101.com
+IS_MYED_DOWN_PATTERN = re.compile(r"^(is +)?(my *ed|learn|[\/&\+])* +down( |\?|$)", re.IGNORECASE | re.MULTILINE)
+
 async def on_message_handle_is_myed_down(message: discord.Message):
     if message.author == bot.user:
         return
 
+    # Cheap check before the regex, since almost no message will match
+    if "down" not in message.content.lower():
+        return
+
     try:
-        # Check if the message is a status check via a very simple:tm: regex
-        # thx regex101.com
-        if re.match(r"^(is +)?(my *ed|learn|[\/&\+])* +down( |\?|$)", message.content, re.IGNORECASE | re.MULTILINE):
+        if IS_MYED_DOWN_PATTERN.match(message.content):
+            # Every replica sees the question, but only one should answer it
+            if not await shared_state.claim(f"status-reply:{message.id}", INSTANCE_ID, 60 * 60):
+                return
             await message.channel.trigger_typing()
 
-            # check if myed is down
-            try:
-                response = requests.get("https://www.myed.ed.ac.uk/myed-progressive/", timeout=5)
-                # check if the status code is 200
-                myed_up = response.status_code == 200
-                myed_down_reason = None if myed_up else "Status: " + str(response.status_code)
-            except requests.exceptions.RequestException as e:
-                # some connection error e.g. name not resolved
-                myed_up = False
-                myed_down_reason = str(e)
-
-            # check if learn is down
-            try:
-                response = requests.get("https://www.learn.ed.ac.uk/", timeout=5)
-                # check if the status code is 200
-                learn_up = response.status_code == 200
-                learn_down_reason = None if learn_up else "Status: " + str(response.status_code)
-            except requests.exceptions.RequestException as e:
-                # some connection error e.g. name not resolved
-                learn_up = False
-                learn_down_reason = str(e)
+            # Probe all services at once, so this takes as long as the slowest
+            # one rather than the sum of all of them
+            results = await asyncio.gather(*[
+                get_service_status(url) for _, url in STATUS_SERVICES
+            ])
 
             random_response = [
                 "I can answer that!",
@@ -415,18 +2320,14 @@ async def on_message_handle_is_myed_down(message: discord.Message):
                     discord.Embed(
                         title=random.choice(random_response),
                         description=f"Here's the current status of the University's services.\nFor accurate info, see https://alerts.is.ed.ac.uk/",
-                        color=discord.Color.green() if myed_up and learn_up else discord.Color.red(),
+                        color=discord.Color.green() if all(result.up for result in results) else discord.Color.red(),
                         fields=[
                             discord.EmbedField(
-                                name="MyEd",
-                                value=("✅ Up" if myed_up else f"❌ Down ({myed_down_reason})") + "\n" + "https://www.myed.ed.ac.uk/myed-progressive/",
-                                inline=False,
-                            ),
-                            discord.EmbedField(
-                                name="Learn",
-                                value=("✅ Up" if learn_up else f"❌ Down ({learn_down_reason})") + "\n" + "https://www.learn.ed.ac.uk/",
+                                name=name,
+                                value=("✅ Up" if result.up else f"❌ Down ({result.reason})") + "\n" + url,
                                 inline=False,
-                            ),
+                            )
+                            for (name, url), result in zip(STATUS_SERVICES, results)
                         ]
                     )
                 ],
@@ -435,123 +2336,545 @@ async def on_message_handle_is_myed_down(message: discord.Message):
         # Send any form of error message to the channel
         await message.channel.send("```" + traceback.format_exc() + "```")
 
+SUGGESTIONS_QUEUE_MAX_DEPTH = int(os.environ.get("SUGGESTIONS_QUEUE_MAX_DEPTH", "100"))
+SUGGESTIONS_REACTION_DELAY = float(os.environ.get("SUGGESTIONS_REACTION_DELAY", "0.25"))
+SUGGESTIONS_BACKFILL_LIMIT = int(os.environ.get("SUGGESTIONS_BACKFILL_LIMIT", "50"))
+
+class SuggestionReactor:
+    """
+    Adds the up/down reactions to suggestions from a single background worker,
+    so on_message never waits on the REST calls, suggestions are reacted to in
+    the order they were posted, and a burst is paced at one reaction every
+    `delay` seconds rather than all hitting the reaction rate limit at once.
+
+    At most `max_depth` messages wait in the queue; anything past that is
+    dropped with a warning and picked up by the next startup backfill.
+    """
+
+    def __init__(self, max_depth: int, delay: float):
+        self.queue: "asyncio.Queue[discord.Message]" = asyncio.Queue(max_depth)
+        self.delay = delay
+        # IDs of messages in the queue, so the backfill and on_message don't
+        # both queue the same suggestion
+        self.queued: Set[int] = set()
+        self.emojis: Optional[Tuple[discord.Emoji, discord.Emoji]] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.backfill_task: Optional[asyncio.Task] = None
+
+    def resolve_emojis(self, suggestions: SuggestionsSettings) -> bool:
+        up_emoji = bot.get_emoji(suggestions.up_emoji_id)
+        down_emoji = bot.get_emoji(suggestions.down_emoji_id)
+        if up_emoji is None or down_emoji is None:
+            suggestions_log.warning("Up or down emoji could not be found from IDs; re-check config!")
+            self.emojis = None
+            return False
+        self.emojis = (up_emoji, down_emoji)
+        return True
+
+    def start(self, suggestions: SuggestionsSettings):
+        """
+        Called from on_ready: resolve the emojis, and (re)start the worker and
+        a backfill of anything posted while the bot was disconnected.
+        """
+        if not self.resolve_emojis(suggestions):
+            return
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        if self.backfill_task is None or self.backfill_task.done():
+            self.backfill_task = asyncio.create_task(self.backfill(suggestions))
+
+    def enqueue(self, message: discord.Message):
+        if message.id in self.queued:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            suggestions_log.warning(
+                "Suggestion reaction queue is full, dropping message %s", message.id,
+                extra={"channel_id": message.channel.id},
+            )
+            return
+        self.queued.add(message.id)
+
+    async def run(self):
+        while True:
+            message = await self.queue.get()
+            self.queued.discard(message.id)
+            if self.emojis is None:
+                continue
+            # Every replica queues the same suggestions; only one reacts. If
+            # it dies first, the claim expires and a later backfill retries.
+            if not await shared_state.claim(f"suggestion-react:{message.id}", INSTANCE_ID, 60 * 60):
+                continue
+            for emoji in self.emojis:
+                try:
+                    await message.add_reaction(emoji=emoji)
+                except discord.NotFound:
+                    # Deleted before we got to it
+                    break
+                except discord.HTTPException as e:
+                    suggestions_log.warning(
+                        "Couldn't react to message %s: %s", message.id, e,
+                        extra={"channel_id": message.channel.id},
+                    )
+                    break
+                finally:
+                    await asyncio.sleep(self.delay)
+
+    async def backfill(self, suggestions: SuggestionsSettings):
+        """
+        Queue any of the last SUGGESTIONS_BACKFILL_LIMIT suggestions that are
+        missing either of our reactions, oldest first.
+        """
+        channel = bot.get_channel(suggestions.channel_id)
+        if channel is None or self.emojis is None:
+            return
+
+        missing = []
+        try:
+            async for message in channel.history(limit=SUGGESTIONS_BACKFILL_LIMIT):
+                if not is_suggestion(message, suggestions):
+                    continue
+                # Compare by ID, as reactions may hold PartialEmoji objects
+                reacted = {
+                    getattr(reaction.emoji, "id", None)
+                    for reaction in message.reactions if reaction.me
+                }
+                if any(emoji.id not in reacted for emoji in self.emojis):
+                    missing.append(message)
+        except discord.HTTPException as e:
+            suggestions_log.warning("Couldn't read suggestions history: %s", e)
+            return
+
+        for message in reversed(missing):
+            if message.id not in self.queued:
+                # Wait for room rather than dropping, the worker is draining it
+                self.queued.add(message.id)
+                await self.queue.put(message)
+        if missing:
+            suggestions_log.info("Queued %d suggestions missing reactions", len(missing))
+
+suggestion_reactor = SuggestionReactor(SUGGESTIONS_QUEUE_MAX_DEPTH, SUGGESTIONS_REACTION_DELAY)
+
+def is_suggestion(message: discord.Message, suggestions: SuggestionsSettings) -> bool:
+    if message.author == bot.user:
+        # Don't run for own messages
+        return False
+
+    if message.guild is None or message.guild.id != suggestions.guild_id:
+        # Does not match the configuration guild
+        return False
+
+    if message.is_system():
+        # Don't run for system messages
+        return False
+
+    return True
+
 async def handle_suggestion_react(message: discord.Message):
     """Handler for auto-upvote/downvoting messages in the server suggestions
-    channel.
+    channel. Only routed messages from the configured suggestions channel.
+    The reactions themselves are added in the background by
+    suggestion_reactor.
 
     Parameters
     ----------
     message : discord.Message
     """
-    if message.author == bot.user:
-        # Don't run for own messages
+    suggestions = settings.suggestions
+    if suggestions is None:
         return
 
-    if message.guild is None:
-        # Don't run in DMs
-        return
+    if is_suggestion(message, suggestions):
+        suggestion_reactor.enqueue(message)
 
-    if message.is_system():
-        # Don't run for system messages
-        return
+HONEYPOT_PURGE_WINDOW = timedelta(minutes=10)
+RECENT_MESSAGES_PER_AUTHOR = int(os.environ.get("RECENT_MESSAGES_PER_AUTHOR", "200"))
 
-    if (
-        "SERVER_SUGGESTIONS_DISABLE" in os.environ
-        and os.environ["SERVER_SUGGESTIONS_DISABLE"] == "1"
-    ):
-        # Allow disabling via environment variable
-        return
+class RecentMessageIndex:
+    """
+    A bounded index of the messages each author sent within a recent time
+    window, so a spammer's messages can be deleted by ID without paging
+    through the history of every channel.
 
-    if (
-        "SERVER_SUGGESTIONS_CHANNEL_ID" not in os.environ
-        or "SERVER_SUGGESTIONS_GUILD_ID" not in os.environ
-        or "SERVER_SUGGESTIONS_UP_EMOJI_ID" not in os.environ
-        or "SERVER_SUGGESTIONS_DOWN_EMOJI_ID" not in os.environ
-    ):
-        # None of channel, guild, emoji ID were provided
-        print("One or more of the following environment variables not provided:")
-        print("- SERVER_SUGGESTIONS_CHANNEL_ID")
-        print("- SERVER_SUGGESTIONS_GUILD_ID")
-        print("- SERVER_SUGGESTIONS_UP_EMOJI_ID")
-        print("- SERVER_SUGGESTIONS_DOWN_EMOJI_ID")
-        print(
-            "To disable auto-reactions for server suggestions, set SERVER_SUGGESTIONS_DISABLE=1"
+    Each author keeps at most `max_per_author` entries, and entries older than
+    `window` are evicted as new messages come in.
+    """
+
+    def __init__(self, window: timedelta, max_per_author: int):
+        self.window = window
+        self.max_per_author = max_per_author
+        # author ID -> deque of (created_at, channel ID, message ID), oldest first
+        self.messages: Dict[int, Deque[Tuple[datetime, int, int]]] = {}
+        self.started_at = discord.utils.utcnow()
+        self.last_sweep = self.started_at
+
+    def add(self, message: discord.Message):
+        now = discord.utils.utcnow()
+        entries = self.messages.get(message.author.id, None)
+        if entries is None:
+            entries = self.messages[message.author.id] = deque(maxlen=self.max_per_author)
+        entries.append((message.created_at, message.channel.id, message.id))
+
+        # Drop authors who have gone quiet, at most once per window so this is
+        # amortised over many messages
+        if now - self.last_sweep > self.window:
+            self.sweep(now)
+
+    def sweep(self, now: datetime):
+        cutoff = now - self.window
+        for author_id in list(self.messages):
+            entries = self.messages[author_id]
+            while entries and entries[0][0] < cutoff:
+                entries.popleft()
+            if not entries:
+                del self.messages[author_id]
+        self.last_sweep = now
+
+    def messages_since(self, author_id: int, after: datetime) -> Optional[Dict[int, List[int]]]:
+        """
+        Get the IDs of the author's messages sent after the given time, grouped
+        by channel ID.
+
+        Returns None if the index can't vouch for having seen all of them,
+        either because it started after `after` (e.g. the bot restarted) or
+        because the author sent more messages than the index keeps.
+        """
+        if after < self.started_at:
+            return None
+
+        entries = self.messages.get(author_id, None)
+        if entries is None:
+            return {}
+        if len(entries) == entries.maxlen and entries[0][0] >= after:
+            return None
+
+        by_channel: Dict[int, List[int]] = {}
+        for created_at, channel_id, message_id in entries:
+            if created_at >= after:
+                by_channel.setdefault(channel_id, []).append(message_id)
+        return by_channel
+
+recent_messages = RecentMessageIndex(HONEYPOT_PURGE_WINDOW, RECENT_MESSAGES_PER_AUTHOR)
+
+HONEYPOT_PURGE_CONCURRENCY = int(os.environ.get("HONEYPOT_PURGE_CONCURRENCY", "5"))
+
+class PurgeResult(NamedTuple):
+    # A text or voice channel, or a thread
+    channel: discord.abc.Messageable
+    deleted: int
+    # Set if the purge failed part way, in which case `deleted` may be short
+    error: Optional[str]
+    # Author ID -> how many of the deleted messages were theirs
+    deleted_by_author: Dict[int, int]
+
+async def purge_channel(
+    channel: discord.TextChannel,
+    user_ids: Set[int],
+    after: datetime,
+    semaphore: asyncio.Semaphore,
+) -> PurgeResult:
+    """
+    Delete the given users' messages in a channel sent after the given time.
+    Holds the semaphore while purging, to cap how many channels are purged at
+    once.
+    """
+    async with semaphore:
+        try:
+            deleted = await channel.purge(
+                limit=None,
+                after=after,
+                check=lambda msg: msg.author.id in user_ids
+            )
+        except discord.Forbidden:
+            return PurgeResult(channel, 0, "missing permissions", {})
+        except discord.HTTPException as e:
+            return PurgeResult(channel, 0, str(e), {})
+
+    deleted_by_author: Dict[int, int] = {}
+    for message in deleted:
+        deleted_by_author[message.author.id] = deleted_by_author.get(message.author.id, 0) + 1
+    return PurgeResult(channel, len(deleted), None, deleted_by_author)
+
+async def delete_channel_messages(
+    channel: discord.abc.Messageable,
+    messages: List[Tuple[int, int]],
+    semaphore: asyncio.Semaphore,
+) -> PurgeResult:
+    """
+    Delete specific messages in a channel, given as (message ID, author ID)
+    pairs, in bulk-delete requests of at most 100 messages each. Holds the
+    semaphore while deleting.
+    """
+    deleted = 0
+    deleted_by_author: Dict[int, int] = {}
+    async with semaphore:
+        try:
+            for i in range(0, len(messages), 100):
+                chunk = messages[i:i + 100]
+                await channel.delete_messages([discord.Object(id=message_id) for message_id, _ in chunk])
+                deleted += len(chunk)
+                for _, author_id in chunk:
+                    deleted_by_author[author_id] = deleted_by_author.get(author_id, 0) + 1
+        except discord.Forbidden:
+            return PurgeResult(channel, deleted, "missing permissions", deleted_by_author)
+        except discord.HTTPException as e:
+            return PurgeResult(channel, deleted, str(e), deleted_by_author)
+    return PurgeResult(channel, deleted, None, deleted_by_author)
+
+def format_purge_summary(
+    members: List[discord.Member],
+    results: List[PurgeResult],
+    skipped: List[Tuple[str, str]],
+    elapsed: float,
+) -> str:
+    """
+    Build the moderation channel report for a honeypot purge, listing only the
+    channels where something was deleted or went wrong, and any channels that
+    couldn't be purged at all, given as (mention, reason) pairs.
+    """
+    total = sum(result.deleted for result in results)
+    names = ", ".join(member.name for member in members)
+    lines = [
+        f"User(s) {names} have been suspended for 24 hours "
+        f"for sending a message in the honeypot channel.",
+        f"Deleted {total} message(s) across {len(results)} channel(s) in {elapsed:.1f}s.",
+    ]
+    skipped_by_reason: Dict[str, List[str]] = {}
+    for mention, reason in skipped:
+        skipped_by_reason.setdefault(reason, []).append(mention)
+    for reason, mentions in skipped_by_reason.items():
+        lines.append(f"Skipped {len(mentions)} channel(s) ({reason}): {', '.join(mentions)}")
+    for result in sorted(results, key=lambda result: -result.deleted):
+        if result.error is not None:
+            lines.append(f"- {result.channel.mention}: failed ({result.error})")
+        elif result.deleted > 0:
+            lines.append(f"- {result.channel.mention}: {result.deleted}")
+
+    summary = "\n".join(lines)
+    if len(summary) > 2000:
+        summary = summary[:1996] + "\n…"
+    return summary
+
+async def timeout_member(member: discord.Member):
+    try:
+        await member.timeout(
+            discord.utils.utcnow() + timedelta(days=1),
+            reason="Spamming"
         )
+        honeypot_log.info("%s timed out", member.name, extra={"guild_id": member.guild.id, "user_id": member.id})
+        audit_store.record(member.guild.id, bot.user.id, member.id, "timed-out", None, "posted in the honeypot channel")
+    except discord.HTTPException as e:
+        honeypot_log.warning("Failed to time out %s: %s", member.name, e, extra={"guild_id": member.guild.id, "user_id": member.id})
+
+async def handle_spam_pings(user_ids: Set[int], guild_id: int):
+    """Delete 10 minutes of previous messages for every user who sent a
+    message in the honeypot channel (ModerationQueue has already timed them
+    out). All users are purged in one pass over the channels, with one
+    combined report."""
+
+    started = time.perf_counter()
+    cutoff_time = discord.utils.utcnow() - HONEYPOT_PURGE_WINDOW
+    guild = bot.get_guild(guild_id)
+
+    if not guild:
+        honeypot_log.warning("Guild not found", extra={"guild_id": guild_id})
         return
 
-    if (
-        str(message.channel.id) != os.environ["SERVER_SUGGESTIONS_CHANNEL_ID"]
-        or str(message.guild.id) != os.environ["SERVER_SUGGESTIONS_GUILD_ID"]
-    ):
-        # Does not match the configuration channel/guild
+    members = [
+        member for member in map(guild.get_member, sorted(user_ids))
+        if member is not None
+    ]
+    if not members:
+        honeypot_log.warning("User(s) to moderate not found", extra={"guild_id": guild_id, "user_ids": sorted(user_ids)})
         return
+    member_ids = {member.id for member in members}
+
+    semaphore = asyncio.Semaphore(HONEYPOT_PURGE_CONCURRENCY)
+
+    # If we've seen every message they sent in the window, delete exactly those
+    # and only touch the channels they actually posted in
+    indexed: Optional[Dict[int, List[Tuple[int, int]]]] = {}
+    for member_id in member_ids:
+        messages = recent_messages.messages_since(member_id, cutoff_time)
+        if messages is None:
+            indexed = None
+            break
+        for channel_id, message_ids in messages.items():
+            indexed.setdefault(channel_id, []).extend(
+                (message_id, member_id) for message_id in message_ids
+            )
 
-    up_emoji = bot.get_emoji(int(os.environ["SERVER_SUGGESTIONS_UP_EMOJI_ID"]))
-    down_emoji = bot.get_emoji(int(os.environ["SERVER_SUGGESTIONS_DOWN_EMOJI_ID"]))
+    skipped: List[Tuple[str, str]] = []
+    if indexed is not None:
+        tasks_to_run = []
+        for channel_id, channel_messages in indexed.items():
+            # Messages in threads and voice channel chats are indexed by the
+            # thread or voice channel's ID
+            channel = guild.get_channel_or_thread(channel_id)
+            if channel is None:
+                skipped.append((f"<#{channel_id}>", "channel not found"))
+            elif not hasattr(channel, "delete_messages"):
+                skipped.append((channel.mention, "can't delete messages there"))
+            else:
+                tasks_to_run.append(delete_channel_messages(channel, channel_messages, semaphore))
+    else:
+        # Otherwise (e.g. just after a restart) fall back to scanning every
+        # channel where we can both read history and delete messages
+        channels = []
+        for channel in guild.text_channels:
+            permissions = channel.permissions_for(guild.me)
+            if permissions.read_message_history and permissions.manage_messages:
+                channels.append(channel)
+            else:
+                skipped.append((channel.mention, "missing permissions"))
+        tasks_to_run = [
+            purge_channel(channel, member_ids, cutoff_time, semaphore)
+            for channel in channels
+        ]
+
+    results = await asyncio.gather(*tasks_to_run)
+    elapsed = time.perf_counter() - started
+
+    HONEYPOT_USERS.inc(len(members))
+    HONEYPOT_DELETED_MESSAGES.inc(sum(result.deleted for result in results))
+    for member in members:
+        deleted = sum(result.deleted_by_author.get(member.id, 0) for result in results)
+        audit_store.record(
+            guild_id, bot.user.id, member.id, "messages-purged", None,
+            f"{deleted} of their message(s) deleted",
+        )
+    HONEYPOT_PURGE_SECONDS.observe(elapsed, mode="indexed" if indexed is not None else "scan")
+
+    summary = format_purge_summary(members, results, skipped, elapsed)
+    honeypot_log.info(
+        summary,
+        extra={
+            "guild_id": guild_id,
+            "user_ids": sorted(member_ids),
+            "deleted": sum(result.deleted for result in results),
+            "purge_seconds": elapsed,
+        },
+    )
 
-    if up_emoji is None or down_emoji is None:
-        print("Up or down emoji could not be found from IDs; re-check config!")
+    mod_channel = guild.get_channel(settings.moderation_channel_id)
+    if not mod_channel:
+        honeypot_log.warning("Mod channel not found", extra={"guild_id": guild_id})
         return
 
-    await message.add_reaction(emoji=up_emoji)
-    await message.add_reaction(emoji=down_emoji)
+    try:
+        await mod_channel.send(summary)
+    except discord.HTTPException as e:
+        honeypot_log.warning("Failed to send moderation report: %s", e, extra={"guild_id": guild_id})
 
-async def handle_spam_pings(user_id: int, guild_id: int):
-    """Delete 10 minutes of previous messages and suspend for 24 hours if a
-    user sends a message in the honeypot channel"""
+HONEYPOT_BATCH_WINDOW = float(os.environ.get("HONEYPOT_BATCH_WINDOW", "2"))
 
-    cutoff_time = discord.utils.utcnow() - timedelta(minutes=10)
-    guild = bot.get_guild(guild_id)
+class ModerationQueue:
+    """
+    Times out each honeypot trigger straight away, then purges their messages
+    in batches, so a raid of many accounts posting at once costs one purge
+    pass per channel rather than one per account.
 
-    if not guild:
-        print(f"Guild {guild_id} not found")
-        return
+    The first trigger in a guild starts a `window` second timer; every user
+    who triggers before it runs is purged in the same batch. A user who was
+    already handled within the last `dedupe_for` is ignored.
+    """
 
-    try:
-        member = guild.get_member(user_id)
-
-        if member:
-            for channel in guild.text_channels:
-                deleted = await channel.purge(
-                    limit=None,
-                    after=cutoff_time,
-                    check=lambda msg: msg.author.id == member.id
-                )
+    def __init__(self, window: float, dedupe_for: timedelta):
+        self.window = window
+        self.dedupe_for = dedupe_for.total_seconds()
+        # guild ID -> user ID -> their timeout task, for the next batch
+        self.pending: Dict[int, Dict[int, asyncio.Task]] = {}
+        # (guild ID, user ID) -> time.monotonic() at which they were queued
+        self.recently_queued: Dict[Tuple[int, int], float] = {}
+
+    def trigger(self, user_id: int, guild_id: int):
+        now = time.monotonic()
+        for key, queued_at in list(self.recently_queued.items()):
+            if now - queued_at > self.dedupe_for:
+                del self.recently_queued[key]
+
+        if (guild_id, user_id) in self.recently_queued:
+            return
+        self.recently_queued[(guild_id, user_id)] = now
 
-                print(f"@{member.name}'s deleted messages in #{channel.name}: {deleted}")
+        asyncio.create_task(self.handle(user_id, guild_id))
 
-            await member.timeout(
-                discord.utils.utcnow() + timedelta(days=1),
-                reason="Spamming"
-            )
+    async def handle(self, user_id: int, guild_id: int):
+        # Other replicas see the same honeypot messages; only handle users
+        # that no other instance has already claimed
+        if not await shared_state.claim(f"honeypot:{guild_id}:{user_id}", INSTANCE_ID, self.dedupe_for):
+            return
 
-            print(f"{member.name} timed out")
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(user_id) if guild is not None else None
+        if member is None:
+            honeypot_log.warning("User to moderate not found", extra={"guild_id": guild_id, "user_id": user_id})
+            return
 
-            mod_channel = guild.get_channel(MODERATION_CHANNEL_ID)
-            if mod_channel:
-                await mod_channel.send(
-                    f"User {member.name} has been suspended for 24 hours "
-                    f"for sending a message in the honeypot channel"
-                )
-            else:
-                print("Mod channel not found")
-                return
+        # Time out first and without waiting for the batch, so the spammer
+        # can't post any more while we clean up
+        task = asyncio.create_task(timeout_member(member))
+        if guild_id in self.pending:
+            self.pending[guild_id][user_id] = task
         else:
-            print("User to moderate not found.")
-            return 
-    except discord.Forbidden:
-        print(f"Bot does not have permissions to delete spam in {channel.name}")
-    except discord.HTTPException as e:
-        print(f"Error purging channel {channel.name}: {e}")
+            self.pending[guild_id] = {user_id: task}
+            asyncio.create_task(self.flush_later(guild_id))
+
+    async def flush_later(self, guild_id: int):
+        await asyncio.sleep(self.window)
+        timeouts = self.pending.pop(guild_id, {})
+        # Let the timeouts land before purging, so nothing new slips in after
+        await asyncio.gather(*timeouts.values())
+        if timeouts:
+            await handle_spam_pings(set(timeouts), guild_id)
+
+moderation_queue = ModerationQueue(HONEYPOT_BATCH_WINDOW, HONEYPOT_PURGE_WINDOW)
+
+async def handle_honeypot_message(message: discord.Message):
+    if message.guild is not None:
+        moderation_queue.trigger(message.author.id, message.guild.id)
+
+MessageHandler = Callable[[discord.Message], Awaitable[None]]
+
+def build_message_routes(settings: Settings) -> Dict[int, List[MessageHandler]]:
+    """
+    Build the table of which on_message handlers apply to which channel ID.
+    Channels not in the table use DEFAULT_MESSAGE_HANDLERS.
+    """
+    routes: Dict[int, List[MessageHandler]] = {}
+    if settings.suggestions is not None:
+        routes[settings.suggestions.channel_id] = [
+            handle_suggestion_react,
+            on_message_handle_is_myed_down,
+        ]
+    # Nothing else runs in the honeypot channel, even if it's also (somehow)
+    # the suggestions channel
+    routes[settings.honeypot_channel_id] = [handle_honeypot_message]
+    return routes
+
+DEFAULT_MESSAGE_HANDLERS: List[MessageHandler] = [on_message_handle_is_myed_down]
+message_routes = build_message_routes(settings)
 
 @bot.event
 async def on_message(message: discord.Message):
-    await handle_suggestion_react(message)
-    
-    if str(message.channel.id) == HONEYPOT_CHANNEL_ID:
-        asyncio.create_task(handle_spam_pings(message.author.id, message.guild.id))
-    else:
-        await on_message_handle_is_myed_down(message)
+    if message.guild is not None and message.author != bot.user:
+        recent_messages.add(message)
+
+    for handler in message_routes.get(message.channel.id, DEFAULT_MESSAGE_HANDLERS):
+        await handler(message)
+
+    # Replacing on_message replaces the default handler, which is what runs
+    # the prefix commands
+    await bot.process_commands(message)
 
 if __name__ == "__main__":
+    if "--compile-messages" in sys.argv:
+        try:
+            compile_action_snapshot(MESSAGES_DIR, ACTION_SNAPSHOT)
+        except (OSError, ValueError) as e:
+            messages_log.error("Failed to compile %s: %s", MESSAGES_DIR, e)
+            sys.exit(1)
+        sys.exit(0)
+
     bot.run(os.environ["DISCORD_TOKEN"])